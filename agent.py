@@ -38,6 +38,12 @@ class BaseAgent:
               relabel=False):
         raise NotImplementedError
 
+    def close(self):
+        """
+        Stops whatever the agent runs in the background (nothing by default)
+        """
+        pass
+
 
 class HiAgent(BaseAgent):
     """
@@ -53,7 +59,9 @@ class HiAgent(BaseAgent):
               relabel=False,
               lo_state_seq=None,
               lo_action_seq=None,
-              lo_current_policy=None):
+              lo_seq_start=None,
+              lo_current_policy=None,
+              streams=None):
         """
         a version of train() with extra arguments required by high-level agents
         for relabelling transition tuples later
@@ -67,8 +75,16 @@ class HiAgent(BaseAgent):
         lo_action_seq : np.array: (c, *action.shape)
             array containing the c actions taken by the LoAgent since the last HiAgent training step
 
+        lo_seq_start : int
+            alternative to lo_state_seq / lo_action_seq: index in the MetaAgent's
+            TrajectoryStore at which those c steps begin
+
         lo_current_policy : func: state -> action
-            the act() function of the LoAgent (supplied by a MetaAgent)
+            the LoAgent's policy without exploration (supplied by a MetaAgent)
+
+        streams : np.array: (batch,)
+            when training on a batch of transitions from several environments,
+            the index of the environment each row comes from
         """
 
         raise NotImplementedError
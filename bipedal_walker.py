@@ -1,4 +1,6 @@
 import sys, math
+import multiprocessing as mp
+import functools
 import numpy as np
 
 import Box2D
@@ -9,6 +11,7 @@ from gym import spaces
 from gym.utils import colorize, seeding, EzPickle
 
 from copy import deepcopy
+from frame_renderer import Rasterizer, transform
 
 # This is simple 4-joints walker robot environment.
 #
@@ -110,10 +113,18 @@ class BipedalWalker(gym.Env, EzPickle):
 
     hardcore = False
 
-    def __init__(self):
-        EzPickle.__init__(self)
+    def __init__(self, terrain_pool_size=None):
+        """
+        With a 'terrain_pool_size', reset() generates only that many terrains (per seed) and then draws
+        one of them at random: drawing the terrain that is already in the world keeps its static bodies,
+        and only the hull, legs and joints are rebuilt. Only the pool of the current seed is kept.
+        """
+        EzPickle.__init__(self, terrain_pool_size)
+        self.terrain_pool_size = terrain_pool_size
+        self.terrain_index = None  # index in the pool of the terrain currently in the world
         self.seed()
         self.viewer = None
+        self.rasterizer = None
 
         self.world = Box2D.b2World()
         self.terrain = None
@@ -145,14 +156,19 @@ class BipedalWalker(gym.Env, EzPickle):
 
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
+        if self.terrain_pool_size is not None:
+            self.terrain_index = None  # whatever is in the world comes from another pool
+            self.terrain_pool = []
         return [seed]
 
-    def _destroy(self):
+    def _destroy(self, keep_terrain=False):
         if not self.terrain: return
         self.world.contactListener = None
-        for t in self.terrain:
-            self.world.DestroyBody(t)
-        self.terrain = []
+        if not keep_terrain:
+            for t in self.terrain:
+                self.world.DestroyBody(t)
+            self.terrain = []
+            self.terrain_index = None
         self.world.DestroyBody(self.hull)
         self.hull = None
         for leg in self.legs:
@@ -274,6 +290,31 @@ class BipedalWalker(gym.Env, EzPickle):
             self.terrain_poly.append( (poly, color) )
         self.terrain.reverse()
 
+    def _terrain_description(self):
+        """
+        Everything needed to build the current terrain again, without the Box2D objects
+        """
+        bodies = []
+        for t in self.terrain:
+            shape = t.fixtures[0].shape
+            bodies.append((isinstance(shape, edgeShape), [tuple(v) for v in shape.vertices], t.color1, t.color2))
+        return dict(bodies=bodies, terrain_x=self.terrain_x, terrain_y=self.terrain_y,
+                    terrain_poly=self.terrain_poly, cloud_poly=self.cloud_poly)
+
+    def _build_terrain(self, description):
+        self.terrain = []
+        for is_edge, vertices, color1, color2 in description['bodies']:
+            fixture = self.fd_edge if is_edge else self.fd_polygon
+            fixture.shape.vertices = vertices
+            t = self.world.CreateStaticBody(
+                fixtures = fixture)
+            t.color1, t.color2 = color1, color2
+            self.terrain.append(t)
+        self.terrain_x = description['terrain_x']
+        self.terrain_y = description['terrain_y']
+        self.terrain_poly = description['terrain_poly']
+        self.cloud_poly = description['cloud_poly']
+
     def _generate_clouds(self):
         # Sorry for the clouds, couldn't resist
         self.cloud_poly   = []
@@ -289,7 +330,14 @@ class BipedalWalker(gym.Env, EzPickle):
             self.cloud_poly.append( (poly,x1,x2) )
 
     def reset(self):
-        self._destroy()
+        keep_terrain = False
+        if self.terrain_pool_size is not None:
+            if len(self.terrain_pool) < self.terrain_pool_size:
+                index = len(self.terrain_pool)  # still filling the pool: a new terrain
+            else:
+                index = self.np_random.randint(self.terrain_pool_size)
+            keep_terrain = index == self.terrain_index
+        self._destroy(keep_terrain)
         self.world.contactListener_bug_workaround = ContactDetector(self)
         self.world.contactListener = self.world.contactListener_bug_workaround
         self.game_over = False
@@ -300,8 +348,17 @@ class BipedalWalker(gym.Env, EzPickle):
         W = VIEWPORT_W/SCALE
         H = VIEWPORT_H/SCALE
 
-        self._generate_terrain(self.hardcore)
-        self._generate_clouds()
+        if self.terrain_pool_size is None:
+            self._generate_terrain(self.hardcore)
+            self._generate_clouds()
+        elif not keep_terrain:
+            if index < len(self.terrain_pool):
+                self._build_terrain(self.terrain_pool[index])
+            else:
+                self._generate_terrain(self.hardcore)
+                self._generate_clouds()
+                self.terrain_pool.append(self._terrain_description())
+            self.terrain_index = index
 
         init_x = TERRAIN_STEP*TERRAIN_STARTPAD/2
         init_y = TERRAIN_HEIGHT+2*LEG_H
@@ -447,13 +504,20 @@ class BipedalWalker(gym.Env, EzPickle):
         return np.expand_dims(np.array(state), axis=0), reward, done, {} #added batch dimension
 
     def render(self, mode='human', goal_state=None):
-        from gym.envs.classic_control import rendering
-        if self.viewer is None:
-            self.viewer = rendering.Viewer(VIEWPORT_W, VIEWPORT_H)
-        self.viewer.set_bounds(self.scroll, VIEWPORT_W/SCALE + self.scroll, 0, VIEWPORT_H/SCALE)
+        if mode == 'rgb_array':
+            # offscreen, no window or OpenGL context needed
+            if self.rasterizer is None:
+                self.rasterizer = Rasterizer(VIEWPORT_W, VIEWPORT_H)
+            canvas = self.rasterizer
+        else:
+            from gym.envs.classic_control import rendering
+            if self.viewer is None:
+                self.viewer = rendering.Viewer(VIEWPORT_W, VIEWPORT_H)
+            canvas = self.viewer
+        canvas.set_bounds(self.scroll, VIEWPORT_W/SCALE + self.scroll, 0, VIEWPORT_H/SCALE)
 
         # draw sky?
-        self.viewer.draw_polygon( [
+        canvas.draw_polygon( [
             (self.scroll,                  0),
             (self.scroll+VIEWPORT_W/SCALE, 0),
             (self.scroll+VIEWPORT_W/SCALE, VIEWPORT_H/SCALE),
@@ -464,44 +528,54 @@ class BipedalWalker(gym.Env, EzPickle):
         for poly,x1,x2 in self.cloud_poly:
             if x2 < self.scroll/2: continue
             if x1 > self.scroll/2 + VIEWPORT_W/SCALE: continue
-            self.viewer.draw_polygon( [(p[0]+self.scroll/2, p[1]) for p in poly], color=(1,1,1))
+            canvas.draw_polygon( [(p[0]+self.scroll/2, p[1]) for p in poly], color=(1,1,1))
         
         # draw ground?
         for poly, color in self.terrain_poly:
             if poly[1][0] < self.scroll: continue
             if poly[0][0] > self.scroll + VIEWPORT_W/SCALE: continue
-            self.viewer.draw_polygon(poly, color=color)
+            canvas.draw_polygon(poly, color=color)
 
         # draw the laser - not part of state, so we can ignore
         self.lidar_render = (self.lidar_render+1) % 100
         i = self.lidar_render
         if i < 2*len(self.lidar):
             l = self.lidar[i] if i < len(self.lidar) else self.lidar[len(self.lidar)-i-1]
-            self.viewer.draw_polyline( [l.p1, l.p2], color=(1,0,0), linewidth=1 )
+            canvas.draw_polyline( [l.p1, l.p2], color=(1,0,0), linewidth=1 )
 
         # draw the robot. here we go...
         for obj in self.drawlist:
             for f in obj.fixtures:
                 trans = f.body.transform
-                if type(f.shape) is circleShape:
+                if type(f.shape) is circleShape and canvas is self.rasterizer:
+                    canvas.draw_circle(trans*f.shape.pos, f.shape.radius, color=obj.color2)
+                    canvas.draw_circle(trans*f.shape.pos, f.shape.radius - 2/SCALE, color=obj.color1)
+                elif type(f.shape) is circleShape:
                     t = rendering.Transform(translation=trans*f.shape.pos)
-                    self.viewer.draw_circle(f.shape.radius, 30, color=obj.color1).add_attr(t)
-                    self.viewer.draw_circle(f.shape.radius, 30, color=obj.color2, filled=False, linewidth=2).add_attr(t)
+                    canvas.draw_circle(f.shape.radius, 30, color=obj.color1).add_attr(t)
+                    canvas.draw_circle(f.shape.radius, 30, color=obj.color2, filled=False, linewidth=2).add_attr(t)
                 else:
                     path = [trans*v for v in f.shape.vertices]
-                    self.viewer.draw_polygon(path, color=obj.color1)
+                    canvas.draw_polygon(path, color=obj.color1)
                     path.append(path[0])
-                    self.viewer.draw_polyline(path, color=obj.color2, linewidth=2)
+                    canvas.draw_polyline(path, color=obj.color2, linewidth=2)
 
         flagy1 = TERRAIN_HEIGHT
         flagy2 = flagy1 + 50/SCALE
         x = TERRAIN_STEP*3
-        self.viewer.draw_polyline( [(x, flagy1), (x, flagy2)], color=(0,0,0), linewidth=2 )
+        canvas.draw_polyline( [(x, flagy1), (x, flagy2)], color=(0,0,0), linewidth=2 )
         f = [(x, flagy2), (x, flagy2-10/SCALE), (x+25/SCALE, flagy2-5/SCALE)]
-        self.viewer.draw_polygon(f, color=(0.9,0.2,0) )
-        self.viewer.draw_polyline(f + [f[0]], color=(0,0,0), linewidth=2 )
+        canvas.draw_polygon(f, color=(0.9,0.2,0) )
+        canvas.draw_polyline(f + [f[0]], color=(0,0,0), linewidth=2 )
 
-        return self.viewer.render(return_rgb_array = mode=='rgb_array')
+        # render goal state from HL agent: outline of the hull at the goal hull angle
+        if goal_state is not None:
+            path = [tuple(v) for v in transform(np.array(HULL_POLY)/SCALE, tuple(self.hull.position), goal_state[0])]
+            canvas.draw_polyline(path + [path[0]], color=(.8,.2,.8), linewidth=2)
+
+        if mode == 'rgb_array':
+            return self.rasterizer.get_frame()
+        return self.viewer.render()
 
     def close(self):
         if self.viewer is not None:
@@ -511,6 +585,115 @@ class BipedalWalker(gym.Env, EzPickle):
 class BipedalWalkerHardcore(BipedalWalker):
     hardcore = True
 
+def _walker_worker(index, pipe, env_cls, seed, shared):
+    # runs in its own process: steps one walker and writes its results into the shared arrays
+    observations, rewards, dones, terminal_observations, actions = [
+        np.frombuffer(array, dtype=np.float64).reshape(shape) for array, shape in shared]
+    env = env_cls()
+    env.seed(seed)
+    while True:
+        command = pipe.recv()
+        if command == 'step':
+            obs, reward, done, _ = env.step(actions[index])
+            rewards[index] = reward
+            dones[index] = done
+            if done:
+                terminal_observations[index] = obs[0]
+                obs = env.reset()
+            observations[index] = obs[0]
+        elif command == 'reset':
+            observations[index] = env.reset()[0]
+        elif command[0] == 'render':
+            # frames are only sent when asked for, so no memory is set aside for them up front
+            pipe.send(env.render('rgb_array', goal_state=command[1]))
+            continue
+        elif command == 'close':
+            env.close()
+            pipe.send(None)
+            break
+        pipe.send(None)
+
+class SubprocVectorBipedalWalker(gym.Env):
+    """
+    K walkers, each stepped in its own worker process.
+
+    Same interface as continuous_cartpole.VectorContinuousCartPoleEnv: step() takes (K, 4) actions and
+    returns (K, 24) observations, (K,) rewards and (K,) done flags, resetting finished walkers straight away
+    (their final observations are in info['terminal_observations']).
+    Actions and results go through shared memory, the pipes only carry the commands (and the frames of render()).
+    """
+    metadata = {
+        'render.modes': ['rgb_array'],
+        'video.frames_per_second' : FPS
+    }
+
+    def __init__(self, n_envs, hardcore=False, seed=None, terrain_pool_size=None):
+        self.n_envs = n_envs
+        high = np.array([np.inf]*24)
+        self.action_space = spaces.Box(np.array([-1,-1,-1,-1]), np.array([+1,+1,+1,+1]))
+        self.observation_space = spaces.Box(-high, high)
+
+        shapes = [(n_envs, 24), (n_envs, ), (n_envs, ), (n_envs, 24), (n_envs, 4)]
+        shared = [(mp.RawArray('d', int(np.prod(shape))), shape) for shape in shapes]
+        self.observations, self.rewards, self.dones, self.terminal_observations, self.actions = [
+            np.frombuffer(array, dtype=np.float64).reshape(shape) for array, shape in shared]
+
+        if seed is None:
+            seed = np.random.randint(9999)
+        env_cls = BipedalWalkerHardcore if hardcore else BipedalWalker
+        if terrain_pool_size is not None:
+            env_cls = functools.partial(env_cls, terrain_pool_size=terrain_pool_size)
+        self.pipes = []
+        self.processes = []
+        for i in range(n_envs):
+            parent_pipe, child_pipe = mp.Pipe()
+            process = mp.Process(target=_walker_worker, args=(i, child_pipe, env_cls, seed + i, shared), daemon=True)
+            process.start()
+            self.pipes.append(parent_pipe)
+            self.processes.append(process)
+
+    def _command(self, command, which=None):
+        which = range(self.n_envs) if which is None else which
+        for i in which:
+            self.pipes[i].send(command)
+        for i in which:
+            self.pipes[i].recv()
+
+    def step(self, actions):
+        self.actions[:] = np.reshape(actions, (self.n_envs, 4))
+        self._command('step')
+        dones = self.dones.astype(np.bool_)
+        return np.copy(self.observations), np.copy(self.rewards), dones, {
+            'terminal_observations': np.copy(self.terminal_observations[dones])}
+
+    def reset(self):
+        self._command('reset')
+        return np.copy(self.observations)
+
+    def reset_done(self, dones):
+        """
+        Resets only the walkers flagged in 'dones' (e.g. ones that ran out of time), returns all observations
+        """
+        self._command('reset', which=np.flatnonzero(dones))
+        return np.copy(self.observations)
+
+    def render(self, mode='rgb_array', goal_states=None):
+        """
+        Offscreen frames of all the walkers, (K, 400, 600, 3) uint8, each rasterized in its worker.
+        goal_states (K, 24) are drawn as the HIRO goal overlay
+        """
+        assert mode == 'rgb_array', 'the vectorized walker only renders offscreen'
+        for i in range(self.n_envs):
+            self.pipes[i].send(('render', None if goal_states is None else goal_states[i]))
+        return np.stack([self.pipes[i].recv() for i in range(self.n_envs)])
+
+    def close(self):
+        if self.processes:
+            self._command('close')
+            for process in self.processes:
+                process.join()
+            self.processes = []
+
 if __name__=="__main__":
     # Heurisic: suboptimal, have no notion of balance.
     env = BipedalWalker()
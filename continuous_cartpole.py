@@ -3,7 +3,10 @@ import gym
 from gym import spaces, logger
 from gym.utils import seeding
 import numpy as np
-from copy import deepcopy
+from frame_renderer import Rasterizer, transform
+
+SCREEN_WIDTH = 800
+SCREEN_HEIGHT = 400
 
 class ContinuousCartPoleEnv(gym.Env):
     metadata = {
@@ -37,15 +40,14 @@ class ContinuousCartPoleEnv(gym.Env):
 
         self.seed()
         self.viewer = None
+        self.rasterizer = None
         self.state = None
 
         self.steps_beyond_done = None
 
         if reward_function is None:
             def reward(cart_pole):
-                if cart_pole.state[0] < -self.x_threshold or cart_pole.state[0] > self.x_threshold:
-                  return -1
-                return 1 if -0.1 <= angle_normalize(cart_pole.state[2]) <= 0.1 else 0
+                return cart_pole_reward(cart_pole, np.reshape(cart_pole.state, (1, 4)))[0]
             self.reward = reward
         else:
             self.reward = reward_function
@@ -56,25 +58,8 @@ class ContinuousCartPoleEnv(gym.Env):
 
     def step(self, action):
         assert self.action_space.contains(action), "%r (%s) invalid"%(action, type(action))
-        state = self.state
-        x, x_dot, theta, theta_dot = state
-        force = self.force_mag * action[0]
-        costheta = math.cos(theta)
-        sintheta = math.sin(theta)
-        temp = (force + self.polemass_length * theta_dot * theta_dot * sintheta) / self.total_mass
-        thetaacc = (self.gravity * sintheta - costheta* temp) / (self.length * (4.0/3.0 - self.masspole * costheta * costheta / self.total_mass))
-        xacc  = temp - self.polemass_length * thetaacc * costheta / self.total_mass
-        if self.kinematics_integrator == 'euler':
-            x  = x + self.tau * x_dot
-            x_dot = x_dot + self.tau * xacc
-            theta = theta + self.tau * theta_dot
-            theta_dot = theta_dot + self.tau * thetaacc
-        else: # semi-implicit euler
-            x_dot = x_dot + self.tau * xacc
-            x  = x + self.tau * x_dot
-            theta_dot = theta_dot + self.tau * thetaacc
-            theta = theta + self.tau * theta_dot
-        self.state = (x,x_dot,theta,theta_dot)
+        self.state = cart_pole_dynamics(self, np.reshape(self.state, (1, 4)), np.reshape(action, (1, 1)))[0]
+        x = self.state[0]
 
         done =  x < -self.x_threshold or x > self.x_threshold
         done = bool(done)
@@ -90,159 +75,208 @@ class ContinuousCartPoleEnv(gym.Env):
         return np.expand_dims(self.state, axis=0)
 
     def render(self, mode='human', goal_state=None):
-        x_org = 100
-        track_width = 600
-        screen_width = track_width + 2 * x_org
-        screen_height = 400
-
-        scale = track_width/self.world_width
-        carty = 150 # TOP OF CART
-        polewidth = 10.0
-        polelen = scale * (2 * self.length)
-        cartwidth = 50.0
-        cartheight = 30.0
-        arrowwidth = 7.0
-        arrowlenmax = 2*cartwidth
-        max_cart_vel = 5.0 
-        max_pole_vel = 10.0
+        if self.state is None: return None
+
+        if mode == 'rgb_array':
+            # offscreen, no window or OpenGL context needed
+            if self.rasterizer is None:
+                self.rasterizer = Rasterizer(SCREEN_WIDTH, SCREEN_HEIGHT)
+            draw_cart_pole(self.rasterizer, self, self.state, goal_state)
+            return self.rasterizer.get_frame()
 
         if self.viewer is None:
             from gym.envs.classic_control import rendering
-            self.viewer = rendering.Viewer(screen_width, screen_height)
-
-            # Track
-            self.track = rendering.Line((x_org,carty), (x_org+track_width,carty))
-            self.track.set_color(0,0,0)
-            self.viewer.add_geom(self.track)
-
-            # Cart
-            l,r,t,b = -cartwidth/2, cartwidth/2, cartheight/2, -cartheight/2
-            #axleoffset =cartheight/4.0
-            axleoffset = 0
-            cart = rendering.FilledPolygon([(l,b), (l,t), (r,t), (r,b)])
-            self.carttrans = rendering.Transform()
-            cart.add_attr(self.carttrans)
-            self.viewer.add_geom(cart)
-
-            # Pole
-            l,r,t,b = -polewidth/2,polewidth/2,polelen-polewidth/2,-polewidth/2
-            pole = rendering.FilledPolygon([(l,b), (l,t), (r,t), (r,b)])
-            pole.set_color(.8,.6,.4)
-            self.poletrans = rendering.Transform()
-            pole.add_attr(self.poletrans)
-            pole.add_attr(self.carttrans)
-            self.viewer.add_geom(pole)
-
-            # Axle
-            self.axle = rendering.make_circle(polewidth/2)
-            self.axle.add_attr(self.poletrans)
-            self.axle.add_attr(self.carttrans)
-            self.axle.set_color(.5,.5,.8)
-            self.viewer.add_geom(self.axle)
-            
-
-            # render goal state from HL agent
-            if goal_state is not None:
-                self.cart_goal = deepcopy(cart)
-                #cart_goal_frame = rendering.make_polygon(self.cart_goal.v,filled=False)
-                
-                self.pole_goal = deepcopy(pole)
-                #pole_goal_frame = rendering.make_polygon(self.pole_goal.v,filled=False)
-
-                self.cart_goal.set_color(.7,.3,.7) #pink?
-                self.pole_goal.set_color(.8,.2,.8) #pinker?
-
-                self.viewer.add_geom(self.cart_goal)
-                self.viewer.add_geom(self.pole_goal)
-                #self.viewer.add_geom(cart_goal_frame)
-                #self.viewer.add_geom(pole_goal_frame)
-
-                self.carttrans_goal = self.cart_goal.attrs[-1]
-                self.poletrans_goal = self.pole_goal.attrs[-2]
-                self.pole_goal.attrs[-1] = self.carttrans_goal # so that we can just change this once below
-                
-                #cart_goal_frame.add_attr(self.carttrans_goal)
-                #pole_goal_frame.add_attr(self.poletrans_goal)
-                #pole_goal_frame.add_attr(self.carttrans_goal)
-
-
-                # Arrow points
-                l,r,t,b, m = 0, arrowlenmax, arrowwidth/2, -arrowwidth/2, 0
-
-                # Cart velocity goal ARROW
-                goal_cart_arrow_body = rendering.FilledPolygon([(l,b), (l,t), (r,t), (r,b)])
-                goal_cart_arrow_head = rendering.FilledPolygon([(r,3*t), (r+4*t,m), (r,3*b)])
-                
-                ac = polelen
-                goal_pole_arrow_body = rendering.FilledPolygon([(l,b+ac), (l,t+ac), (r,t+ac), (r,b+ac)])
-                goal_pole_arrow_head = rendering.FilledPolygon([(r,3*t+ac), (r+4*t,m+ac), (r,3*b+ac)])
-
-                #arrow_color = [0, .45, .45] #green
-                arrow_color = [.45, .45, .45] #green
-                goal_cart_arrow_body.set_color(*arrow_color) 
-                goal_cart_arrow_head.set_color(*arrow_color) 
-                goal_pole_arrow_body.set_color(*arrow_color) 
-                goal_pole_arrow_head.set_color(*arrow_color) 
-
-                self.goal_cart_arrow_trans = rendering.Transform()
-                goal_cart_arrow_body.add_attr(self.goal_cart_arrow_trans)
-                goal_cart_arrow_head.add_attr(self.goal_cart_arrow_trans)
-                self.goal_pole_arrow_trans = rendering.Transform()
-                goal_pole_arrow_body.add_attr(self.goal_pole_arrow_trans)
-                goal_pole_arrow_head.add_attr(self.goal_pole_arrow_trans)
-                self.viewer.add_geom(goal_cart_arrow_body)
-                self.viewer.add_geom(goal_cart_arrow_head)
-                self.viewer.add_geom(goal_pole_arrow_body)
-                self.viewer.add_geom(goal_pole_arrow_head)
-
-
-            self._pole_geom = pole
-
-        if self.state is None: return None
-
-        # Edit the pole polygon vertex
-        pole = self._pole_geom
-        l,r,t,b = -polewidth/2, polewidth/2, polelen-polewidth/2, -polewidth/2
-        pole.v = [(l,b), (l,t), (r,t), (r,b)]
-
-        x = self.state
-        cartx = x[0]*scale+screen_width/2.0 # MIDDLE OF CART
-        self.carttrans.set_translation(cartx, carty)
-        self.poletrans.set_rotation(-x[2])
-
-        # render goal state from HL agent
-        if goal_state is not None:
-            cartx_goal = goal_state[0]*scale+screen_width/2.0 # MIDDLE OF CART
-            self.carttrans_goal.set_translation(cartx_goal, carty)
-            self.poletrans_goal.set_rotation(-goal_state[2])
-
-            # Cart velocity goal ARROW
-            self.goal_cart_arrow_trans.set_translation(cartx_goal, carty)
-            cart_arrow_scale = goal_state[1] / max_cart_vel
-            self.goal_cart_arrow_trans.set_scale(newy=1, newx=cart_arrow_scale)
-
-            # Pole velocity goal ARROW
-            self.goal_pole_arrow_trans.set_translation(cartx_goal, carty)
-            pole_arrow_scale = goal_state[3] / max_pole_vel
-            self.goal_pole_arrow_trans.set_scale(newy=1, newx=pole_arrow_scale)
-            self.goal_pole_arrow_trans.set_rotation(-goal_state[2])
-            
-            # Goal cart color
-            #goal_cart_vel_norm = goal_state[1] / max_cart_vel
-            #(red, blue) = (1, 0) if goal_cart_vel_norm > 0 else (0,1)
-            #self.cart_goal.set_color(red, 0, blue, abs(goal_cart_vel_norm))
-
-            # Goal pole color
-            #goal_pole_vel_norm = goal_state[3] / max_pole_vel
-            #(red, blue) = (1, 0) if goal_pole_vel_norm > 0 else (0,1)
-            #self.pole_goal.set_color(red, 0, blue, abs(goal_pole_vel_norm))
-
-        return self.viewer.render(return_rgb_array = mode=='rgb_array')
+            self.viewer = rendering.Viewer(SCREEN_WIDTH, SCREEN_HEIGHT)
+        draw_cart_pole(self.viewer, self, self.state, goal_state)
+        return self.viewer.render()
 
     def close(self):
         if self.viewer:
             self.viewer.close()
             self.viewer = None
 
+class VectorContinuousCartPoleEnv(gym.Env):
+    """
+    N independent continuous cartpoles, stepped together with numpy.
+
+    step() takes an (N, 1) action array and returns (N, 4) observations, (N,) rewards and
+    (N,) done flags. Carts that are done get reset straight away, so the observation returned for them
+    is already the first one of their next episode (the final one is in info['terminal_observations']).
+    """
+    metadata = {
+        'render.modes': ['rgb_array'],
+        'video.frames_per_second' : 50
+    }
+
+    def __init__(self, n_envs, reward_function=None):
+        self.n_envs = n_envs
+        single_env = ContinuousCartPoleEnv()
+        for attr in ['gravity', 'masscart', 'masspole', 'total_mass', 'length',
+                     'polemass_length', 'force_mag', 'tau', 'kinematics_integrator',
+                     'x_threshold', 'world_width']:
+            setattr(self, attr, getattr(single_env, attr))
+
+        self.action_space = single_env.action_space
+        self.observation_space = single_env.observation_space
+
+        self.seed()
+        self.state = None
+        self.rasterizer = None
+
+        if reward_function is None:
+            def reward(cart_poles):
+                return cart_pole_reward(cart_poles, cart_poles.state)
+            self.reward = reward
+        else:
+            # called with this env, must return an (N,) array
+            self.reward = reward_function
+
+    def seed(self, seed=None):
+        self.np_random, seed = seeding.np_random(seed)
+        return [seed]
+
+    def _initial_states(self, n):
+        state = self.np_random.uniform(low=-0.05, high=0.05, size=(n, 4))
+        state[:, 2] += np.pi
+        return state
+
+    def step(self, actions):
+        actions = np.reshape(actions, (self.n_envs, -1))
+        assert np.all(np.abs(actions) <= 1), "%r invalid"%(actions, )
+        self.state = cart_pole_dynamics(self, self.state, actions)
+        x = self.state[:, 0]
+
+        dones = (x < -self.x_threshold) | (x > self.x_threshold)
+
+        rewards = self.reward(self)
+
+        terminal_observations = self.state[dones]
+        if dones.any():
+            self.state[dones] = self._initial_states(np.sum(dones))
+
+        return np.copy(self.state), rewards, dones, {'terminal_observations': terminal_observations}
+
+    def reset(self):
+        self.state = self._initial_states(self.n_envs)
+        return np.copy(self.state)
+
+    def reset_done(self, dones):
+        """
+        Resets only the carts flagged in 'dones' (e.g. ones that ran out of time), returns all observations
+        """
+        if np.any(dones):
+            self.state[dones] = self._initial_states(np.sum(dones))
+        return np.copy(self.state)
+
+    def render(self, mode='rgb_array', goal_states=None):
+        """
+        Offscreen frames of all the carts, (N, SCREEN_HEIGHT, SCREEN_WIDTH, 3) uint8. goal_states (N, 4) are drawn
+        as the HIRO goal overlay, like ContinuousCartPoleEnv.render's goal_state
+        """
+        assert mode == 'rgb_array', 'the vectorized cartpole only renders offscreen'
+        if self.state is None: return None
+        if self.rasterizer is None:
+            self.rasterizer = Rasterizer(SCREEN_WIDTH, SCREEN_HEIGHT)
+        frames = np.empty((self.n_envs, SCREEN_HEIGHT, SCREEN_WIDTH, 3), dtype=np.uint8)
+        for i, state in enumerate(self.state):
+            draw_cart_pole(self.rasterizer, self, state,
+                           None if goal_states is None else goal_states[i])
+            frames[i] = self.rasterizer.frame
+        return frames
+
+
+def draw_cart_pole(canvas, env, state, goal_state=None):
+    """
+    Draws the cart pole in 'state' (and the goal state from the HL agent, if any) on 'canvas':
+    a gym rendering.Viewer, or a frame_renderer.Rasterizer for offscreen frames
+    """
+    x_org = 100
+    track_width = SCREEN_WIDTH - 2 * x_org
+
+    scale = track_width/env.world_width
+    carty = 150 # TOP OF CART
+    polewidth = 10.0
+    polelen = scale * (2 * env.length)
+    cartwidth = 50.0
+    cartheight = 30.0
+    arrowwidth = 7.0
+    arrowlenmax = 2*cartwidth
+    max_cart_vel = 5.0
+    max_pole_vel = 10.0
+
+    l,r,t,b = -cartwidth/2, cartwidth/2, cartheight/2, -cartheight/2
+    cart = [(l,b), (l,t), (r,t), (r,b)]
+    l,r,t,b = -polewidth/2,polewidth/2,polelen-polewidth/2,-polewidth/2
+    pole = [(l,b), (l,t), (r,t), (r,b)]
+    # same 30-gon as rendering.make_circle
+    angles = 2 * np.pi * np.arange(30) / 30
+    axle = np.stack([np.cos(angles), np.sin(angles)], axis=1) * polewidth/2
+
+    # Background
+    canvas.draw_polygon([(0,0), (SCREEN_WIDTH,0), (SCREEN_WIDTH,SCREEN_HEIGHT), (0,SCREEN_HEIGHT)], color=(1,1,1))
+
+    # Track
+    canvas.draw_polyline([(x_org,carty), (x_org+track_width,carty)], color=(0,0,0))
+
+    # Cart, pole and axle
+    cartx = state[0]*scale+SCREEN_WIDTH/2.0 # MIDDLE OF CART
+    canvas.draw_polygon(transform(cart, (cartx, carty)), color=(0,0,0))
+    canvas.draw_polygon(transform(pole, (cartx, carty), -state[2]), color=(.8,.6,.4))
+    canvas.draw_polygon(transform(axle, (cartx, carty)), color=(.5,.5,.8))
+
+    # render goal state from HL agent
+    if goal_state is not None:
+        cartx_goal = goal_state[0]*scale+SCREEN_WIDTH/2.0 # MIDDLE OF CART
+        canvas.draw_polygon(transform(cart, (cartx_goal, carty)), color=(.7,.3,.7)) #pink?
+        canvas.draw_polygon(transform(pole, (cartx_goal, carty), -goal_state[2]), color=(.8,.2,.8)) #pinker?
+
+        # velocity goal arrows, lengths scaled by the goal velocities
+        l,r,t,b, m = 0, arrowlenmax, arrowwidth/2, -arrowwidth/2, 0
+        ac = polelen
+        arrow_color = (.45, .45, .45)
+        cart_arrow_scale = (goal_state[1] / max_cart_vel, 1)
+        pole_arrow_scale = (goal_state[3] / max_pole_vel, 1)
+        for body, head, rotation, arrow_scale in [
+                ([(l,b), (l,t), (r,t), (r,b)], [(r,3*t), (r+4*t,m), (r,3*b)], 0, cart_arrow_scale),
+                ([(l,b+ac), (l,t+ac), (r,t+ac), (r,b+ac)], [(r,3*t+ac), (r+4*t,m+ac), (r,3*b+ac)],
+                 -goal_state[2], pole_arrow_scale)]:
+            canvas.draw_polygon(transform(body, (cartx_goal, carty), rotation, arrow_scale), color=arrow_color)
+            canvas.draw_polygon(transform(head, (cartx_goal, carty), rotation, arrow_scale), color=arrow_color)
+
+
+def cart_pole_dynamics(cart_pole, states, actions):
+    """
+    One step of the cart-pole physics for a batch: states (N, 4), actions (N, 1) in (-1, 1) -> next states (N, 4).
+    'cart_pole' provides the physical constants (any of the cart-pole envs, or TeachersModel)
+    """
+    x, x_dot, theta, theta_dot = states.T
+    force = cart_pole.force_mag * actions[:, 0]
+    costheta = np.cos(theta)
+    sintheta = np.sin(theta)
+    temp = (force + cart_pole.polemass_length * theta_dot * theta_dot * sintheta) / cart_pole.total_mass
+    thetaacc = (cart_pole.gravity * sintheta - costheta* temp) / (cart_pole.length * (4.0/3.0 - cart_pole.masspole * costheta * costheta / cart_pole.total_mass))
+    xacc  = temp - cart_pole.polemass_length * thetaacc * costheta / cart_pole.total_mass
+    if cart_pole.kinematics_integrator == 'euler':
+        x  = x + cart_pole.tau * x_dot
+        x_dot = x_dot + cart_pole.tau * xacc
+        theta = theta + cart_pole.tau * theta_dot
+        theta_dot = theta_dot + cart_pole.tau * thetaacc
+    else: # semi-implicit euler
+        x_dot = x_dot + cart_pole.tau * xacc
+        x  = x + cart_pole.tau * x_dot
+        theta_dot = theta_dot + cart_pole.tau * thetaacc
+        theta = theta + cart_pole.tau * theta_dot
+    return np.stack([x, x_dot, theta, theta_dot], axis=1)
+
+
+def cart_pole_reward(cart_pole, states):
+    """
+    Default reward for a batch of states (N, 4) -> (N,): -1 off the track, 1 with the pole upright, else 0
+    """
+    x, theta = states[:, 0], states[:, 2]
+    upright = np.abs(angle_normalize(theta)) <= 0.1
+    return np.where(np.abs(x) > cart_pole.x_threshold, -1, upright.astype(np.float64))
+
+
 def angle_normalize(x):
     return (((x+np.pi) % (2*np.pi)) - np.pi)
@@ -0,0 +1,212 @@
+from ddpg_agent.numpy_actor import NumpyActor
+import multiprocessing as mp
+import numpy as np
+import queue
+
+
+def _actor_worker(index, env_fn, seed, transitions, weights, action_low,
+                  action_high, exploration_magnitude,
+                  exploration_magnitude_min, exploration_decay, warmup_steps,
+                  max_steps_per_ep, timeout_penalty, chunk_size):
+    """
+    Runs in every actor process: steps its own environment with a numpy copy of the actor
+    (uniformly random actions for the first 'warmup_steps', then gaussian exploration, as in DDPGAgent.act),
+    sends the transitions to the learner in chunks and switches to the newest weights broadcast by the learner whenever there are some.
+    Every finished episode is reported with the actor's current exploration magnitude.
+    Receiving None instead of weights stops the actor.
+    """
+    np.random.seed(seed)
+    env = env_fn()
+    env.seed(seed)
+    actor = NumpyActor.from_layers(weights.get())
+    explr_magnitude = exploration_magnitude
+
+    chunk = []
+    score, steps, total_steps = 0, 0, 0
+    state = np.reshape(env.reset(), (1, -1))
+    while True:
+        # only the most recent weights matter
+        try:
+            while True:
+                layers = weights.get_nowait()
+                if layers is None:
+                    return
+                actor.layers = layers
+        except queue.Empty:
+            pass
+
+        if total_steps < warmup_steps:
+            action = np.random.uniform(-1, 1, size=(1, *action_low.shape))
+        else:
+            action = actor(state).astype(np.float64)  #tanh'd (-1, 1)
+            action += np.random.normal(
+                scale=explr_magnitude, size=action.shape)
+            action = np.clip(action, a_min=-1, a_max=1)
+            if explr_magnitude > exploration_magnitude_min:
+                explr_magnitude *= exploration_decay
+        scaled_action = action * (action_high - action_low) / 2 + (
+            action_high + action_low) / 2
+
+        next_state, reward, done, _ = env.step(
+            np.squeeze(scaled_action, axis=0))
+        next_state = np.reshape(next_state, (1, -1))
+        steps += 1
+        total_steps += 1
+        if steps >= max_steps_per_ep:
+            reward -= timeout_penalty
+            done = True
+        score += reward
+
+        chunk.append((state[0], action[0], reward, next_state[0], done))
+        if len(chunk) == chunk_size or done:
+            transitions.put(('transitions', index,
+                             [np.array(field) for field in zip(*chunk)]))
+            chunk = []
+
+        if done:
+            transitions.put(('episode', index, score, steps, explr_magnitude))
+            score, steps = 0, 0
+            state = np.reshape(env.reset(), (1, -1))
+        else:
+            state = next_state
+
+
+class ActorLearner():
+    def __init__(self,
+                 agent,
+                 env_fn,
+                 n_actors: int = 4,
+                 broadcast_every: int = 100,
+                 chunk_size: int = 50,
+                 max_steps_per_ep: int = 2000,
+                 timeout_penalty: float = 0.,
+                 max_update_ratio: float = 1.,
+                 seed: int = None):
+        """
+        Trains the (trainable) DDPGAgent 'agent' with experience collected by 'n_actors' processes.
+
+        Every actor process builds its own environment with 'env_fn' (a picklable callable, e.g. the
+        environment class) and acts with a numpy copy of agent's actor, using the agent's exploration
+        settings; the agent's learning_starts warm-up steps of uniformly random actions are split among them.
+        Transitions come back over a queue in chunks of up to 'chunk_size'; this process
+        (the learner) adds them to the agent's replay buffer and runs gradient steps as fast as it can,
+        but never ahead of the agent's train_freq / gradient_steps schedule (see DDPGAgent.scheduled_updates())
+        nor more than 'max_update_ratio' of them per environment step collected so far
+        (it waits for the actors instead), so it can't overfit an almost empty buffer.
+        The actor weights are broadcast to the actors every 'broadcast_every' gradient steps.
+        """
+        self.agent = agent
+        self.env_fn = env_fn
+        self.n_actors = n_actors
+        self.broadcast_every = broadcast_every
+        self.chunk_size = chunk_size
+        self.max_steps_per_ep = max_steps_per_ep
+        self.timeout_penalty = timeout_penalty
+        self.max_update_ratio = max_update_ratio
+        self.seed = np.random.randint(9999) if seed is None else seed
+
+        self.numpy_actor = agent.numpy_actor if agent.numpy_actor is not None else NumpyActor(
+            agent.actor_behaviour)
+        self.transitions = None
+        self.weights = []
+        self.processes = []
+
+        self.total_steps = 0  # environment steps received from all actors
+        self.n_updates = 0  # gradient steps taken by the learner
+
+    def start(self):
+        self.transitions = mp.Queue()
+        for i in range(self.n_actors):
+            weights = mp.Queue()
+            weights.put(self.numpy_actor.layers)
+            process = mp.Process(
+                target=_actor_worker,
+                args=(i, self.env_fn, self.seed + i, self.transitions,
+                      weights, self.agent.action_space.low,
+                      self.agent.action_space.high,
+                      self.agent.explr_magnitude,
+                      self.agent.explr_magnitude_min, self.agent.explr_decay,
+                      -(-self.agent.learning_starts // self.n_actors),
+                      self.max_steps_per_ep, self.timeout_penalty,
+                      self.chunk_size),
+                daemon=True)
+            process.start()
+            self.weights.append(weights)
+            self.processes.append(process)
+
+    def broadcast(self):
+        """
+        Sends the current actor weights to all actors
+        """
+        if self.numpy_actor is not self.agent.numpy_actor:
+            self.numpy_actor.refresh()
+        for weights in self.weights:
+            weights.put(self.numpy_actor.layers)
+
+    def _receive(self, block: bool):
+        """
+        Everything the actors have sent so far (waits for at least one message if 'block')
+        """
+        messages = []
+        try:
+            messages.append(self.transitions.get(block=block))
+            while True:
+                messages.append(self.transitions.get_nowait())
+        except queue.Empty:
+            pass
+        return messages
+
+    def _ahead(self) -> bool:
+        return self.n_updates >= min(self.agent.scheduled_updates(),
+                                     self.max_update_ratio * self.total_steps)
+
+    def episodes(self, n_steps: int):
+        """
+        Runs the learner until the actors have taken 'n_steps' environment steps in total.
+        Yields (actor index, score, steps, mean loss of the gradient steps since the last yield,
+        exploration magnitude the actor is using) for every episode an actor finishes,
+        so that the caller can log, save or stop early.
+        """
+        if not self.processes:
+            self.start()
+
+        loss_sum, n_losses = 0, 0
+        while self.total_steps < n_steps:
+            # nothing (or not enough) to learn from yet: wait for the actors
+            warming_up = not self.agent.can_learn()
+            for message in self._receive(block=warming_up or self._ahead()):
+                if message[0] == 'transitions':
+                    _, index, (states, actions, rewards, next_states,
+                               dones) = message
+                    self.agent.add_transitions(
+                        states,
+                        actions,
+                        rewards,
+                        next_states,
+                        dones,
+                        streams=np.full(states.shape[0], index))
+                    self.total_steps += states.shape[0]
+                else:
+                    _, index, score, steps, explr_magnitude = message
+                    yield index, score, steps, loss_sum / max(
+                        n_losses, 1), explr_magnitude
+                    loss_sum, n_losses = 0, 0
+            if warming_up or self._ahead():
+                continue
+
+            loss_sum += self.agent.learn()
+            n_losses += 1
+            self.n_updates += 1
+            if self.n_updates % self.broadcast_every == 0:
+                self.broadcast()
+
+    def stop(self):
+        for weights in self.weights:
+            weights.put(None)
+        for process in self.processes:
+            # keep draining, actors can't finish while their last chunks are stuck in the queue
+            while process.is_alive():
+                self._receive(block=False)
+                process.join(timeout=0.1)
+        self.processes = []
+        self.weights = []
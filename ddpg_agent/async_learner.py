@@ -0,0 +1,90 @@
+import tensorflow as tf
+import threading
+
+
+class AsyncLearner():
+    def __init__(self, agent, max_update_ratio: float = 1.):
+        """
+        Runs the gradient steps of the (trainable) DDPGAgent 'agent' on a background thread,
+        so that the main thread can keep stepping the environment in the meantime:
+        the main thread only adds transitions (agent.add_transitions()) and reports them with step().
+
+        The learner never gets ahead of the agent's train_freq / gradient_steps / learning_starts schedule
+        (see DDPGAgent.scheduled_updates()), nor of 'max_update_ratio' gradient steps per environment step,
+        but it may fall behind them if the environment is faster.
+        act() should run on the agent's numpy actor (numpy_inference=True), which the learner refreshes.
+        Hold 'update_lock' to keep the networks still, e.g. while saving them.
+        An exception on the learner thread ends it and is raised again by the next step(), pop_loss() or stop().
+        """
+        self.agent = agent
+        self.max_update_ratio = max_update_ratio
+        self.graph = tf.get_default_graph()
+
+        self.n_env_steps = 0
+        self.n_updates = 0
+        self.loss_sum, self.n_losses = 0, 0
+
+        self.condition = threading.Condition()
+        self.update_lock = threading.Lock()
+        self.running = True
+        self.error = None  # exception that ended the learner thread
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self._learn()
+        except BaseException as error:
+            with self.condition:
+                self.error = error
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError('the learner thread failed') from self.error
+
+    def _ahead(self) -> bool:
+        return self.n_updates >= min(self.agent.scheduled_updates(),
+                                     self.max_update_ratio * self.n_env_steps)
+
+    def _learn(self):
+        # the default graph is thread-local
+        with self.graph.as_default():
+            while True:
+                with self.condition:
+                    while self.running and (
+                            not self.agent.can_learn() or self._ahead()):
+                        self.condition.wait()
+                    if not self.running:
+                        return
+                with self.update_lock:
+                    loss = self.agent.learn()
+                with self.condition:
+                    self.n_updates += 1
+                    self.loss_sum += loss
+                    self.n_losses += 1
+
+    def step(self, n: int = 1):
+        """
+        Reports 'n' new environment steps (whose transitions are already in the replay buffer)
+        """
+        with self.condition:
+            self._raise_error()
+            self.n_env_steps += n
+            self.condition.notify()
+
+    def pop_loss(self) -> float:
+        """
+        Mean loss of the gradient steps since the last call
+        """
+        with self.condition:
+            self._raise_error()
+            loss = self.loss_sum / max(self.n_losses, 1)
+            self.loss_sum, self.n_losses = 0, 0
+        return loss
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self._raise_error()
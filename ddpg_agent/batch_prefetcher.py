@@ -0,0 +1,72 @@
+from ddpg_agent.replay_buffer import ReplayBuffer
+import numpy as np
+import queue
+import threading
+
+
+class BatchPrefetcher():
+    def __init__(self, replay_buffer: ReplayBuffer, n_batches: int = 2):
+        """
+        Samples batches from 'replay_buffer' on a background thread, so that
+        the learner only has to pop a ready-made one in next_batch().
+
+        Batches are copied into 'n_batches' + 1 preallocated slots that get recycled:
+        the slot returned by next_batch() stays untouched until the following call,
+        so it can be modified in place (e.g. relabelled).
+        Sampling and replay_buffer.add() are serialised on replay_buffer.lock, so a batch
+        only ever contains transitions that were completely written when it was sampled.
+        """
+        self.replay_buffer = replay_buffer
+        self.n_batches = n_batches
+        self.slots = None  # allocated once the buffer can fill a whole batch
+        self.free_slots = queue.Queue()
+        self.ready_slots = queue.Queue()
+        self.in_use = None  # slot currently handed out to the learner
+
+        self.running = True
+        self.thread = None
+
+    def _start(self, example_batch):
+        self.slots = [
+            type(example_batch)(*[np.empty_like(x) for x in example_batch])
+            for _ in range(self.n_batches + 1)
+        ]
+        for i in range(len(self.slots)):
+            self.free_slots.put(i)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            i = self.free_slots.get()
+            if i is None:
+                break
+            with self.replay_buffer.lock:
+                batch = self.replay_buffer.sample_batch()
+            for dst, src in zip(self.slots[i], batch):
+                np.copyto(dst, src)
+            self.ready_slots.put(i)
+
+    def next_batch(self):
+        """
+        Returns the next prefetched batch
+        """
+        if self.slots is None:
+            # batches would still change size; sample in the foreground until the buffer is big enough
+            with self.replay_buffer.lock:
+                batch = self.replay_buffer.sample_batch()
+                if len(self.replay_buffer) < self.replay_buffer.batch_size:
+                    return batch
+            self._start(batch)
+            return batch
+
+        if self.in_use is not None:
+            self.free_slots.put(self.in_use)
+        self.in_use = self.ready_slots.get()
+        return self.slots[self.in_use]
+
+    def stop(self):
+        self.running = False
+        self.free_slots.put(None)
+        if self.thread is not None:
+            self.thread.join()
@@ -1,14 +1,26 @@
 from agent import BaseAgent, HiAgent
 from ddpg_agent.replay_buffer import ReplayBuffer
+from ddpg_agent.prioritized_replay_buffer import PrioritizedReplayBuffer
+from ddpg_agent.memmap_replay_buffer import MemmapReplayBuffer
+from ddpg_agent.batch_prefetcher import BatchPrefetcher
+from ddpg_agent.target_updater import TargetUpdater
+from ddpg_agent.numpy_actor import NumpyActor
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Dense, Flatten, BatchNormalization, ReLU
 from tensorflow.keras.initializers import RandomNormal
 from ddpg_agent.ou_noise import OUNoise
+from collections import namedtuple
 
 import os
 
+# placeholders and ops of the single-session learner step (see DDPGAgent.build_fused_step)
+FusedStep = namedtuple('FusedStep', [
+    'states_before', 'actions', 'rewards', 'states_after', 'discounts',
+    'done_flags', 'weights', 'train_op', 'loss', 'td_errors'
+])
+
 
 class DDPGAgent(HiAgent):
     def __init__(
@@ -20,13 +32,21 @@ class DDPGAgent(HiAgent):
             critic_behaviour: Sequential = None,
             critic_target: Sequential = None,
             replay_buffer: ReplayBuffer = None,
+            batch_prefetcher: BatchPrefetcher = None,
             train_actor_op: tf.Tensor = None,
+            fused_step: FusedStep = None,
+            target_updater: TargetUpdater = None,
             discount_factor=0.99,
             tau=0.001,
             exploration_mode="no_exploration",
             exploration_magnitude=0.4,
             exploration_magnitude_min=0.05,
             exploration_decay=0.9999,
+            numpy_inference=False,
+            numpy_refresh_every=1,
+            train_freq=1,
+            gradient_steps=1,
+            learning_starts=0,
             **kwargs,
     ):
         super().__init__(state_space, action_space)
@@ -35,7 +55,10 @@ class DDPGAgent(HiAgent):
         self.critic_behaviour = critic_behaviour
         self.critic_target = critic_target
         self.replay_buffer = replay_buffer
+        self.batch_prefetcher = batch_prefetcher
         self.train_actor_op = train_actor_op
+        self.fused_step = fused_step
+        self.target_updater = target_updater
         self.discount_factor = discount_factor
         self.tau = tau
         self.explr_mode = exploration_mode
@@ -44,12 +67,37 @@ class DDPGAgent(HiAgent):
         self.explr_decay = exploration_decay
         self.ou_noise = OUNoise(self.action_space.shape[0])
 
+        # act() can run the actor as plain numpy matmuls, refreshed every few training steps
+        self.numpy_actor = NumpyActor(
+            self.actor_behaviour) if numpy_inference else None
+        self.numpy_refresh_every = numpy_refresh_every
+        self.n_train_steps = 0
+
+        # train() takes 'gradient_steps' gradient steps every 'train_freq' environment steps,
+        # but none (and acts randomly) until 'learning_starts' steps have been collected
+        self.train_freq = train_freq
+        self.gradient_steps = gradient_steps
+        self.learning_starts = learning_starts
+        self.n_env_steps = 0
+
     @classmethod
     def new_trainable_agent(cls,
                             learning_rate_actor=0.0001,
                             learning_rate_critic=0.0001,
                             batch_size=32,
+                            buffer_size=20000,
+                            replay_dir=None,
                             use_long_buffer=False,
+                            trajectory_store=None,
+                            use_ring_buffer=True,
+                            use_prioritized_buffer=False,
+                            storage_dtype=None,
+                            prefetch_batches=0,
+                            n_step=1,
+                            relabel_cache_staleness=None,
+                            use_fused_step=False,
+                            target_update_every=1,
+                            hard_update_every=None,
                             n_units=[128, 64],
                             weights_stdev=0.000001,
                             **kwargs) -> 'DDPGAgent':
@@ -117,6 +165,29 @@ class DDPGAgent(HiAgent):
         train_actor = tf.train.AdamOptimizer(
             learning_rate_actor).apply_gradients(normalized_actor_gradient)
 
+        # Target network updates, as in-graph assign ops
+        target_updater = TargetUpdater(
+            [act_behav, crit_behav], [act_targ, crit_targ],
+            tau=kwargs.get('tau', 0.001),
+            soft_every=target_update_every,
+            hard_every=hard_update_every)
+
+        fused_step = None
+        if use_fused_step:
+            # a Polyak update on every step can simply be part of the fused op
+            fold_target_update = target_update_every == 1 and hard_update_every is None
+            fused_step = cls.build_fused_step(
+                act_behav,
+                act_targ,
+                crit_behav,
+                crit_targ,
+                learning_rate_actor=learning_rate_actor,
+                learning_rate_critic=learning_rate_critic,
+                tau=kwargs.get('tau', 0.001),
+                update_targets=fold_target_update)
+            if fold_target_update:
+                target_updater = None
+
         # Initialize variable
         session = tf.keras.backend.get_session()
         session.run(tf.global_variables_initializer())
@@ -126,8 +197,43 @@ class DDPGAgent(HiAgent):
         act_targ.set_weights(act_behav.get_weights())
 
         # Create replay buffer
-        replay_buffer = ReplayBuffer(
-            buffer_size=20000, batch_size=batch_size, use_long=use_long_buffer)
+        n_step_kwargs = dict(
+            n_step=n_step,
+            discount_factor=kwargs.get('discount_factor', 0.99),
+            relabel_cache_staleness=relabel_cache_staleness)
+        if replay_dir is not None:
+            # file-backed, so it can outgrow RAM and survive restarts
+            replay_buffer = MemmapReplayBuffer(
+                buffer_dir=replay_dir,
+                buffer_size=buffer_size,
+                batch_size=batch_size,
+                use_long=use_long_buffer,
+                trajectory_store=trajectory_store,
+                storage_dtype=storage_dtype,
+                **n_step_kwargs)
+        elif use_prioritized_buffer:
+            replay_buffer = PrioritizedReplayBuffer(
+                buffer_size=buffer_size,
+                batch_size=batch_size,
+                use_long=use_long_buffer,
+                trajectory_store=trajectory_store,
+                storage_dtype=storage_dtype,
+                **n_step_kwargs)
+        else:
+            replay_buffer = ReplayBuffer(
+                buffer_size=buffer_size,
+                batch_size=batch_size,
+                use_long=use_long_buffer,
+                use_ring=use_ring_buffer,
+                trajectory_store=trajectory_store,
+                storage_dtype=storage_dtype,
+                **n_step_kwargs)
+
+        # Optionally sample batches on a background thread
+        batch_prefetcher = None
+        if prefetch_batches > 0:
+            batch_prefetcher = BatchPrefetcher(
+                replay_buffer, n_batches=prefetch_batches)
 
         return DDPGAgent(
             actor_behaviour=act_behav,
@@ -135,9 +241,72 @@ class DDPGAgent(HiAgent):
             critic_behaviour=crit_behav,
             critic_target=crit_targ,
             replay_buffer=replay_buffer,
+            batch_prefetcher=batch_prefetcher,
             train_actor_op=train_actor,
+            fused_step=fused_step,
+            target_updater=target_updater,
             **kwargs)
 
+    @staticmethod
+    def build_fused_step(act_behav, act_targ, crit_behav, crit_targ,
+                         learning_rate_actor, learning_rate_critic, tau,
+                         update_targets=True) -> FusedStep:
+        """
+        Builds one op that runs a whole learner step: critic targets from the target networks,
+        critic update, actor update (against the updated critic) and, with 'update_targets',
+        Polyak target update, so that train() only needs to feed the batch to a single session.run()
+        """
+        state_dim = act_behav.input_shape[1]
+        n_actions = act_behav.output_shape[1]
+
+        states_before = tf.placeholder(tf.float32, (None, state_dim))
+        actions = tf.placeholder(tf.float32, (None, n_actions))
+        rewards = tf.placeholder(tf.float32, (None, 1))
+        states_after = tf.placeholder(tf.float32, (None, state_dim))
+        discounts = tf.placeholder(tf.float32, (None, 1))
+        done_flags = tf.placeholder(tf.float32, (None, 1))
+        weights = tf.placeholder(tf.float32, (None, 1))
+
+        # train critic
+        target_values = crit_targ(
+            tf.concat([states_after, act_targ(states_after)], axis=1))
+        ys = tf.stop_gradient(rewards +
+                              discounts * target_values * (1 - done_flags))
+        td_errors = ys - crit_behav(tf.concat([states_before, actions], axis=1))
+        critic_loss = tf.reduce_mean(weights * tf.square(td_errors))
+        train_critic = tf.train.AdamOptimizer(learning_rate_critic).minimize(
+            critic_loss, var_list=crit_behav.trainable_variables)
+
+        # train actor, once the critic has been updated
+        with tf.control_dependencies([train_critic]):
+            behaviour_values = crit_behav(
+                tf.concat([states_before, act_behav(states_before)], axis=1))
+            train_actor = tf.train.AdamOptimizer(learning_rate_actor).minimize(
+                -tf.reduce_mean(behaviour_values),
+                var_list=act_behav.trainable_variables)
+
+        # slowly update target weights for actor and critic, once both are trained
+        train_op = train_actor
+        if update_targets:
+            with tf.control_dependencies([train_actor]):
+                train_op = tf.group(*[
+                    t.assign(tau * b + (1 - tau) * t)
+                    for b, t in zip(act_behav.weights + crit_behav.weights,
+                                    act_targ.weights + crit_targ.weights)
+                ])
+
+        return FusedStep(
+            states_before=states_before,
+            actions=actions,
+            rewards=rewards,
+            states_after=states_after,
+            discounts=discounts,
+            done_flags=done_flags,
+            weights=weights,
+            train_op=train_op,
+            loss=critic_loss,
+            td_errors=td_errors)
+
     @classmethod
     def load_pretrained_agent(cls, filepath, **kwargs):
         act_behav = tf.keras.models.load_model(filepath + '/actbeh.model')
@@ -153,7 +322,11 @@ class DDPGAgent(HiAgent):
 
     def act(self, state):
         assert not np.isnan(state).any()
-        action = self.actor_behaviour.predict(state)  #tanh'd (-1, 1)
+        if self.explr_mode != "no_exploration" and self.n_env_steps < self.learning_starts:
+            # warm-up: uniformly random actions, no need for the network
+            return np.random.uniform(
+                -1, 1, size=(state.shape[0], *self.action_space.shape))
+        action = self.policy(state)
 
         if self.explr_mode != "no_exploration":
             if self.explr_mode == "ou_noise":
@@ -175,14 +348,24 @@ class DDPGAgent(HiAgent):
                         action) * noise  # Put them together
             else:
                 raise Exception('Invalid exploration method')
+            # once per environment step, however many environments are stepped side by side
             if self.explr_magnitude > self.explr_magnitude_min:
-                self.explr_magnitude *= self.explr_decay
+                self.explr_magnitude *= self.explr_decay**state.shape[0]
 
         action = np.clip(action, a_min=-1, a_max=1)
 
         assert not np.isnan(action).any()
         return action
 
+    def policy(self, state):
+        """
+        The actor's own actions for a batch of states: no exploration noise, and no decay of it
+        (e.g. to score candidate goals when relabelling)
+        """
+        if self.numpy_actor is not None:
+            return self.numpy_actor(state)  #tanh'd (-1, 1)
+        return self.actor_behaviour.predict(state)  #tanh'd (-1, 1)
+
     def modify_exploration_magnitude(self, factor, mode='increment'):
         if mode == 'increment':
             self.explr_magnitude += factor
@@ -200,31 +383,144 @@ class DDPGAgent(HiAgent):
               relabeller=None,
               lo_state_seq=None,
               lo_action_seq=None,
-              lo_current_policy=None):
+              lo_seq_start=None,
+              lo_current_policy=None,
+              lo_policy_version=None,
+              streams=None):
+        n_scheduled = self.scheduled_updates()
+        self.add_transitions(
+            state,
+            action,
+            reward,
+            next_state,
+            done,
+            lo_state_seq=lo_state_seq,
+            lo_action_seq=lo_action_seq,
+            lo_seq_start=lo_seq_start,
+            streams=streams)
+
+        # how many train_freq boundaries did these environment steps cross?
+        n_updates = self.scheduled_updates() - n_scheduled
+        if n_updates == 0 or not self.can_learn():
+            return None, None
+
+        losses = [
+            self.learn(
+                relabeller=relabeller,
+                lo_current_policy=lo_current_policy,
+                lo_policy_version=lo_policy_version) for _ in range(n_updates)
+        ]
+        return np.mean(losses), None  #to be compatible with return type of MetaAgent
+
+    def add_transitions(self,
+                        state,
+                        action,
+                        reward,
+                        next_state,
+                        done,
+                        lo_state_seq=None,
+                        lo_action_seq=None,
+                        lo_seq_start=None,
+                        streams=None):
+        """
+        What train() does before its gradient step: adds the transitions to the replay buffer
+        """
         assert self.replay_buffer is not None, 'It seems like you are trying to train a pretrained model. Not cool, dude.'
         # add a transition to the buffer
-        self.replay_buffer.add(
-            state_before=np.squeeze(state, axis=0),
-            action=np.squeeze(action, axis=0),
-            state_after=np.squeeze(next_state, axis=0),
-            reward=reward,
-            done_flag=done,
-            lo_state_seq=lo_state_seq,
-            lo_action_seq=lo_action_seq)
+        # (one per row: several environments may be stepped side by side,
+        # in which case reward, done and lo_seq_start come as arrays too,
+        # and 'streams' may name the environment of each row)
+        rewards = np.reshape(reward, -1)
+        dones = np.reshape(done, -1)
+        with self.replay_buffer.lock:
+            for i in range(state.shape[0]):
+                self.replay_buffer.add(
+                    state_before=state[i],
+                    action=action[i],
+                    state_after=next_state[i],
+                    reward=rewards[i],
+                    done_flag=dones[i],
+                    lo_state_seq=lo_state_seq,
+                    lo_action_seq=lo_action_seq,
+                    lo_seq_start=None if lo_seq_start is None else
+                    np.reshape(lo_seq_start, -1)[i],
+                    stream=i if streams is None else streams[i])
+        self.n_env_steps += state.shape[0]
         # ...
 
+    def scheduled_updates(self) -> int:
+        """
+        How many gradient steps the train_freq / gradient_steps / learning_starts schedule
+        has called for over the environment steps taken so far
+        (learners running beside the environment, e.g. AsyncLearner, keep up with this)
+        """
+        if self.n_env_steps < self.learning_starts:
+            return 0
+        return self.gradient_steps * (
+            self.n_env_steps // self.train_freq -
+            max(self.learning_starts - 1, 0) // self.train_freq)
+
+    def can_learn(self) -> bool:
+        """
+        Whether learn() may run: past 'learning_starts', and with something in the replay buffer
+        (n-step transitions only get there once their window is complete)
+        """
+        return self.n_env_steps >= self.learning_starts and len(
+            self.replay_buffer) > 0
+
+    def learn(self,
+              relabeller=None,
+              lo_current_policy=None,
+              lo_policy_version=None) -> float:
+        """
+        One gradient step on a batch sampled from the replay buffer
+        (what train() does after adding its transitions), returns the critic's loss
+        """
         #sample a batch
-        batch = self.replay_buffer.sample_batch()
+        if self.batch_prefetcher is not None:
+            batch = self.batch_prefetcher.next_batch()
+        else:
+            with self.replay_buffer.lock:
+                batch = self.replay_buffer.sample_batch()
 
         # off policy correction / relabelling!
-        if relabeller is not None:
-            for i in range(batch.actions.shape[0]):
-                batch.actions[i] = relabeller(
-                    orig_hi_action=batch.actions[i],
+        if relabeller is not None and self.replay_buffer.relabel_cache_staleness is not None:
+            # only relabel transitions whose cached goal is missing or too old
+            with self.replay_buffer.lock:
+                goals, stale = self.replay_buffer.cached_relabels(
+                    batch.indices, lo_policy_version, batch.generations)
+            if goals is None:
+                goals = np.empty_like(batch.actions)
+            if stale.any():
+                goals[stale] = relabeller(
+                    orig_hi_actions=batch.actions[stale],
                     goal_scaler=self.scale_action,
-                    lo_state_seq=batch.lo_state_seqs[i],
-                    lo_action_seq=batch.lo_action_seqs[i],
+                    lo_state_seqs=batch.lo_state_seqs[stale],
+                    lo_action_seqs=batch.lo_action_seqs[stale],
                     lo_current_policy=lo_current_policy)
+                with self.replay_buffer.lock:
+                    self.replay_buffer.cache_relabels(
+                        batch.indices[stale], goals[stale], lo_policy_version,
+                        batch.generations[stale])
+            batch.actions[:] = goals
+        elif relabeller is not None:
+            batch.actions[:] = relabeller(
+                orig_hi_actions=batch.actions,
+                goal_scaler=self.scale_action,
+                lo_state_seqs=batch.lo_state_seqs,
+                lo_action_seqs=batch.lo_action_seqs,
+                lo_current_policy=lo_current_policy)
+
+        # n-step batches bring their own discount (gamma ** steps covered)
+        discounts = batch.discounts.reshape(
+            (-1, 1)) if 'discounts' in batch._fields else self.discount_factor
+
+        if self.fused_step is not None:
+            loss = self.train_fused(batch, discounts)
+            if self.target_updater is not None:
+                self.target_updater.step()
+            self.count_train_step()
+            return loss
 
         # ask actor target network for actions ...
         target_actions = self.actor_target.predict(batch.states_after)
@@ -233,11 +529,19 @@ class DDPGAgent(HiAgent):
             np.concatenate((batch.states_after, target_actions), axis=1))
         # train critic
         ys = batch.rewards.reshape(
-            (-1,
-             1)) + self.discount_factor * values * ~(batch.done_flags.reshape(
-                 (-1, 1)))
+            (-1, 1)) + discounts * values * ~(batch.done_flags.reshape(
+                (-1, 1)))
         xs = np.concatenate([batch.states_before, batch.actions], axis=1)
-        info = self.critic_behaviour.fit(xs, ys, verbose=0)
+        if isinstance(self.replay_buffer, PrioritizedReplayBuffer):
+            # TD errors of the sampled transitions become their new priorities
+            td_errors = ys - self.critic_behaviour.predict(xs)
+            with self.replay_buffer.lock:
+                self.replay_buffer.update_priorities(
+                    batch.indices, td_errors, batch.generations)
+            info = self.critic_behaviour.fit(
+                xs, ys, sample_weight=batch.weights, verbose=0)
+        else:
+            info = self.critic_behaviour.fit(xs, ys, verbose=0)
         # train actor
         session = tf.keras.backend.get_session()
 
@@ -251,21 +555,49 @@ class DDPGAgent(HiAgent):
                 batch.states_before
             })
 
-        def update_target_weights(behaviour, target):
-            behaviour_weights = behaviour.get_weights()
-            target_weights = target.get_weights()
-            new_target_weights = [
-                self.tau * b + (1 - self.tau) * t
-                for b, t in zip(behaviour_weights, target_weights)
-            ]
-            target.set_weights(new_target_weights)
-
         # slowly update target weights for actor and critic
-        update_target_weights(self.actor_behaviour, self.actor_target)
-        update_target_weights(self.critic_behaviour, self.critic_target)
+        self.target_updater.step()
+
+        self.count_train_step()
 
-        loss = info.history['loss'][0]
-        return loss, None  #to be compatible with return type of MetaAgent
+        return info.history['loss'][0]
+
+    def count_train_step(self):
+        """
+        Keeps the numpy mirror of the actor (if any) up to date with its training
+        """
+        self.n_train_steps += 1
+        if self.numpy_actor is not None and self.n_train_steps % self.numpy_refresh_every == 0:
+            self.numpy_actor.refresh()
+
+    def train_fused(self, batch, discounts) -> float:
+        """
+        Runs the learner step built by build_fused_step() on a batch, returns the critic loss
+        """
+        n = batch.rewards.shape[0]
+        prioritized = isinstance(self.replay_buffer, PrioritizedReplayBuffer)
+        step = self.fused_step
+
+        session = tf.keras.backend.get_session()
+        _, loss, td_errors = session.run(
+            [step.train_op, step.loss, step.td_errors], {
+                step.states_before: batch.states_before,
+                step.actions: batch.actions,
+                step.rewards: batch.rewards.reshape((-1, 1)),
+                step.states_after: batch.states_after,
+                step.discounts: np.broadcast_to(discounts, (n, 1)),
+                step.done_flags: batch.done_flags.reshape((-1, 1)),
+                step.weights:
+                batch.weights.reshape((-1, 1)) if prioritized else np.ones(
+                    (n, 1)),
+            })
+
+        if prioritized:
+            with self.replay_buffer.lock:
+                self.replay_buffer.update_priorities(
+                    batch.indices, td_errors, batch.generations)
+
+        return loss
 
     def save_model(self, filepath: str):
         if not os.path.exists(filepath):
@@ -280,4 +612,17 @@ class DDPGAgent(HiAgent):
         tf.keras.models.save_model(self.critic_target,
                                    filepath + '/critar.model')
 
+        if isinstance(self.replay_buffer, MemmapReplayBuffer):
+            self.replay_buffer.flush()
+
         print('Models saved.')
+
+    def close(self):
+        """
+        Stops the batch prefetcher (learn() samples in the foreground from then on)
+        """
+        if self.batch_prefetcher is not None:
+            self.batch_prefetcher.stop()
+            self.batch_prefetcher = None
+        if isinstance(self.replay_buffer, MemmapReplayBuffer):
+            self.replay_buffer.flush()
@@ -0,0 +1,101 @@
+from ddpg_agent.replay_buffer import ReplayBuffer
+import numpy as np
+import json
+import os
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    def __init__(self,
+                 buffer_dir: str,
+                 buffer_size: int = 10000,
+                 batch_size: int = 100,
+                 use_long: bool = False,
+                 trajectory_store=None,
+                 storage_dtype=None,
+                 n_step: int = 1,
+                 discount_factor: float = None,
+                 relabel_cache_staleness: int = None):
+        """
+        Ring buffer whose arrays live in numpy.memmap files under 'buffer_dir' (one file per field),
+        so capacities far beyond RAM can be backed by local disk and the OS page cache.
+
+        If 'buffer_dir' already holds a buffer of the same size, it is reopened as it was left:
+        the write cursor and fill level are themselves kept in a small mapped file.
+
+        A 'trajectory_store' is persisted along with the buffer, under 'buffer_dir'/trajectories,
+        since the transitions only keep indices into it.
+        """
+        super().__init__(
+            buffer_size=buffer_size,
+            batch_size=batch_size,
+            use_long=use_long,
+            use_ring=True,
+            trajectory_store=trajectory_store,
+            storage_dtype=storage_dtype,
+            n_step=n_step,
+            discount_factor=discount_factor,
+            relabel_cache_staleness=relabel_cache_staleness)
+        self.buffer_dir = buffer_dir
+        if not os.path.exists(buffer_dir):
+            os.makedirs(buffer_dir)
+
+        self.layout_path = os.path.join(buffer_dir, 'layout.json')
+        self.layout = {}
+        if os.path.exists(self.layout_path):
+            with open(self.layout_path, 'r') as fh:
+                self.layout = json.load(fh)
+            assert self.layout['buffer_size'] == buffer_size, \
+                f'{buffer_dir} holds a buffer of size {self.layout["buffer_size"]}, not {buffer_size}'
+            for field in self.fields:
+                if field in self.layout['fields']:
+                    setattr(self, field, self._open(field, mode='r+'))
+        else:
+            self.layout = {'buffer_size': buffer_size, 'fields': {}}
+
+        counters_path = os.path.join(buffer_dir, 'counters.dat')
+        self.counters = np.memmap(
+            counters_path,
+            dtype=np.int64,
+            mode='r+' if os.path.exists(counters_path) else 'w+',
+            shape=(2, ))
+        self.cursor, self.n_stored = (int(c) for c in self.counters)
+
+        if trajectory_store is not None:
+            trajectory_store.persist(os.path.join(buffer_dir, 'trajectories'))
+
+    def _open(self, field: str, mode: str):
+        entry = self.layout['fields'][field]
+        return np.memmap(
+            os.path.join(self.buffer_dir, field + '.dat'),
+            dtype=np.dtype(entry['dtype']),
+            mode=mode,
+            shape=tuple(entry['shape']))
+
+    def _allocate(self, field: str, example):
+        """
+        Creates the backing file for one field and records its layout for later reopening
+        """
+        shape, dtype = self._layout(field, example)
+        self.layout['fields'][field] = {'shape': shape, 'dtype': dtype.str}
+        with open(self.layout_path, 'w') as fh:
+            json.dump(self.layout, fh)
+        return self._open(field, mode='w+')
+
+    def _store(self, transition: dict):
+        """
+        Writes one transition into the buffer
+        """
+        super()._store(transition)
+        # only advance the persisted counters once the transition itself is written
+        self.counters[:] = (self.cursor, self.n_stored)
+
+    def flush(self):
+        """
+        Writes any dirty pages of the mapped files back to disk
+        """
+        for field in self.fields:
+            if getattr(self, field) is not None:
+                getattr(self, field).flush()
+        self.counters.flush()
+        if self.trajectory_store is not None:
+            self.trajectory_store.flush()
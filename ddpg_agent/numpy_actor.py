@@ -0,0 +1,54 @@
+import numpy as np
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'tanh': lambda x: np.tanh(x, out=x),
+}
+
+
+class NumpyActor():
+    def __init__(self, model):
+        """
+        Mirror of a Sequential of Dense layers (as built by DDPGAgent) evaluated with plain numpy
+        matmuls, which is a lot cheaper than model.predict() for a single state.
+        Call refresh() whenever the model's weights have changed.
+
+        'layers' are plain (kernel, bias, activation name) tuples, so they can be pickled and
+        sent to other processes, which rebuild the actor with NumpyActor.from_layers()
+        """
+        self.model = model
+        self.layers = []
+        if model is not None:
+            self.refresh()
+
+    @classmethod
+    def from_layers(cls, layers) -> 'NumpyActor':
+        """
+        An actor without a model behind it (e.g. in a process without tensorflow)
+        """
+        actor = cls(None)
+        actor.layers = layers
+        return actor
+
+    def refresh(self):
+        """
+        Copies the current weights out of the model
+        """
+        layers = []
+        for layer in self.model.layers:
+            kernel, bias = layer.get_weights()
+            layers.append((np.ascontiguousarray(kernel, dtype=np.float32),
+                                np.ascontiguousarray(bias, dtype=np.float32),
+                                layer.activation.__name__))
+        # swapped in at once: act() may be running on another thread
+        self.layers = layers
+
+    def __call__(self, state):
+        """
+        Same as model.predict(state), for a batch of states
+        """
+        x = np.asarray(state, dtype=np.float32)
+        for kernel, bias, activation in self.layers:
+            x = ACTIVATIONS[activation](x @ kernel + bias)
+        return x
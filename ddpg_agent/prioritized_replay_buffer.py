@@ -0,0 +1,141 @@
+from collections import namedtuple
+from ddpg_agent.replay_buffer import ReplayBuffer, ReplayBatch, ReplayBatchLong, BATCH_TYPES, batch_tuple
+import numpy as np
+
+PrioritizedReplayBatch = namedtuple(
+    'PrioritizedReplayBatch', ReplayBatch._fields + ('weights', 'indices', 'generations'))
+
+PrioritizedReplayBatchLong = namedtuple(
+    'PrioritizedReplayBatch', ReplayBatchLong._fields + ('weights', 'indices', 'generations'))
+
+BATCH_TYPES[PrioritizedReplayBatch._fields] = PrioritizedReplayBatch
+BATCH_TYPES[PrioritizedReplayBatchLong._fields] = PrioritizedReplayBatchLong
+
+
+class SumTree():
+    def __init__(self, capacity: int):
+        """
+        Binary tree stored in a flat array where every node holds the sum of its two children
+        and the leaves hold the priorities. Leaf i lives at index (n_leaves - 1 + i).
+        """
+        # a power of two keeps all leaves on the same level, so a batch can descend in lockstep
+        self.n_leaves = 1
+        while self.n_leaves < capacity:
+            self.n_leaves *= 2
+        self.depth = int(np.log2(self.n_leaves))
+        self.tree = np.zeros(2 * self.n_leaves - 1)
+
+    def total(self) -> float:
+        return self.tree[0]
+
+    def update(self, indices, priorities):
+        """
+        Sets the priorities of the leaves at 'indices' and refreshes their ancestors
+        """
+        nodes = np.asarray(indices) + self.n_leaves - 1
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            # duplicates are harmless: each parent is simply recomputed from its children
+            nodes = np.unique((nodes - 1) // 2)
+            self.tree[nodes] = self.tree[2 * nodes + 1] + self.tree[2 * nodes + 2]
+
+    def find(self, values):
+        """
+        Returns the leaf indices whose cumulative priority range contains each of 'values'
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.zeros(values.shape, dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes + 1
+            go_right = values >= self.tree[left]
+            values = np.where(go_right, values - self.tree[left], values)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - (self.n_leaves - 1)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    def __init__(self,
+                 buffer_size: int = 10000,
+                 batch_size: int = 100,
+                 use_long: bool = False,
+                 trajectory_store=None,
+                 storage_dtype=None,
+                 n_step: int = 1,
+                 discount_factor: float = None,
+                 relabel_cache_staleness: int = None,
+                 alpha: float = 0.6,
+                 beta: float = 0.4,
+                 beta_increment: float = 0.00001,
+                 epsilon: float = 0.00001):
+        """
+        Prioritized experience replay (Schaul et al.) on top of the ring buffer.
+        Transitions are sampled with probability p_i^alpha / sum_k p_k^alpha, where p_i is
+        the last absolute TD error reported for transition i through update_priorities().
+        Batches carry importance-sampling 'weights' (annealed from 'beta' towards 1),
+        the buffer 'indices' of the sampled transitions and the 'generations' of their slots.
+        """
+        super().__init__(
+            buffer_size=buffer_size,
+            batch_size=batch_size,
+            use_long=use_long,
+            use_ring=True,
+            trajectory_store=trajectory_store,
+            storage_dtype=storage_dtype,
+            n_step=n_step,
+            discount_factor=discount_factor,
+            relabel_cache_staleness=relabel_cache_staleness)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon
+        self.max_priority = 1.0  # new transitions get sampled at least once
+        self.sum_tree = SumTree(buffer_size)
+
+    def _store(self, transition: dict):
+        """
+        Writes one transition into the buffer, with the highest priority seen so far
+        """
+        index = self.cursor
+        super()._store(transition)
+        self.sum_tree.update([index], self.max_priority**self.alpha)
+
+    def sample_batch(self):  #-> PrioritizedReplayBatch:
+        """
+        Returns a batch of transtions sampled proportionally to their priorities
+        """
+        b_size = self.batch_size if len(self) > self.batch_size else len(self)
+
+        # stratified: one sample from each of b_size equal slices of the total priority mass
+        total = self.sum_tree.total()
+        values = (np.arange(b_size) + np.random.uniform(size=b_size)) * (
+            total / b_size)
+        pick = self.sum_tree.find(np.minimum(values, np.nextafter(total, 0)))
+        pick = np.minimum(pick, len(self) - 1)  #guard against float round-off
+
+        probabilities = self.sum_tree.tree[pick + self.sum_tree.n_leaves -
+                                           1] / total
+        weights = (len(self) * probabilities)**(-self.beta)
+        weights /= weights.max()
+        self.beta = min(1.0, self.beta + self.beta_increment)
+
+        batch = self._gather(pick)
+        batch['weights'] = weights
+        batch['indices'] = pick
+        batch['generations'] = self.generations[pick]
+
+        return batch_tuple(batch)
+
+    def update_priorities(self, indices, td_errors, generations=None):
+        """
+        Sets the priorities of the transitions at 'indices' from their new TD errors.
+        Given the 'generations' they were sampled with, slots rewritten since then keep their
+        priority: the TD errors belong to the transitions that were there before
+        """
+        priorities = np.abs(np.reshape(td_errors, -1)) + self.epsilon
+        if generations is not None:
+            keep = ~self.rewritten(indices, generations)
+            indices, priorities = np.asarray(indices)[keep], priorities[keep]
+            if len(indices) == 0:
+                return
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.sum_tree.update(indices, priorities**self.alpha)
@@ -1,5 +1,6 @@
 from typing import List
-from collections import namedtuple, deque
+from collections import namedtuple, deque, defaultdict
+import threading
 import numpy as np
 
 ReplayBatch = namedtuple(
@@ -11,29 +12,136 @@ ReplayBatchLong = namedtuple('ReplayBatch', [
     'lo_state_seqs', 'lo_action_seqs'
 ])
 
+# batch namedtuples by field names, for buffers that store extra fields (e.g. 'discounts')
+BATCH_TYPES = {
+    ReplayBatch._fields: ReplayBatch,
+    ReplayBatchLong._fields: ReplayBatchLong
+}
+
+
+def batch_tuple(batch: dict):
+    """
+    Wraps a dict of batch arrays in the namedtuple matching its fields
+    """
+    fields = tuple(batch)
+    if fields not in BATCH_TYPES:
+        BATCH_TYPES[fields] = namedtuple('ReplayBatch', fields)
+    return BATCH_TYPES[fields](**batch)
+
 
 class ReplayBuffer():
+    # fields stored in 'storage_dtype' when one is given
+    COMPACT_FIELDS = [
+        'states_before', 'actions', 'states_after', 'lo_state_seqs',
+        'lo_action_seqs'
+    ]
+
     def __init__(self,
                  buffer_size: int = 10000,
                  batch_size: int = 100,
-                 use_long: bool = False):
+                 use_long: bool = False,
+                 use_ring: bool = False,
+                 trajectory_store=None,
+                 storage_dtype=None,
+                 n_step: int = 1,
+                 discount_factor: float = None,
+                 relabel_cache_staleness: int = None):
         """
         Buffer will keep the most recent 'buffer_size' transitions
         Batches given by the function 'sample_batch()' will have length 'batch_size'
+
+        With 'use_ring', transitions are written in place into fixed-size numpy arrays
+        (allocated on the first add(), once the shapes are known) instead of python lists
+
+        With a 'trajectory_store' (long buffers only), each transition keeps just the start
+        index of its low-level sequences, which are gathered from the store at sample time
+
+        With a 'storage_dtype' (ring buffers only, e.g. np.float32 or np.float16), states and actions
+        are stored in that dtype, rewards as float32 and done flags as packed bits.
+        Batches are upcast back to float64 / bool by sample_batch()
+
+        With 'n_step' > 1, each stored transition covers up to n_step environment steps:
+        rewards become the 'discount_factor'-discounted sum over those steps, states_after the state
+        n_step steps later (or at the end of the episode), and batches carry a 'discounts' field
+        (discount_factor ** steps covered) to bootstrap the critic target with
+
+        With a 'relabel_cache_staleness' (ring buffers only), the buffer remembers the relabelled
+        hi action of each transition with the lo policy version it was computed under
+        (see cached_relabels()), and batches carry the buffer 'indices' of their transitions
+        and the 'generations' those slots had when sampled (see cache_relabels())
         """
         self.buffer_size = buffer_size
         self.batch_size = batch_size
-        self.states_before = []
-        self.actions = []
-        self.states_after = []
-        self.rewards = []
-        self.done_flags = []
-
         self.use_long = use_long
+        self.use_ring = use_ring
+        self.trajectory_store = trajectory_store
+        self.storage_dtype = storage_dtype
+        assert self.storage_dtype is None or self.use_ring, 'compact storage needs use_ring'
+        self.relabel_cache_staleness = relabel_cache_staleness
+        assert self.relabel_cache_staleness is None or self.use_ring, 'relabel cache needs use_ring'
+        self.relabelled_actions = None  # allocated on the first cache_relabels()
+        self.relabel_versions = None
+
+        # held by whoever writes or samples while a BatchPrefetcher may be sampling in the background
+        self.lock = threading.Lock()
+
+        self.n_step = n_step
+        self.discount_factor = discount_factor
+        if self.n_step > 1:
+            assert self.discount_factor is not None, 'n-step returns need a discount_factor'
+            # transitions whose n-step return is not complete yet, per stream (environment)
+            self.pending = defaultdict(deque)
+
+        self.fields = list(ReplayBatch._fields)
+        if self.n_step > 1:
+            self.fields += ['discounts']
+        if self.use_long and self.trajectory_store is not None:
+            self.fields += ['lo_seq_starts']
+        elif self.use_long:
+            self.fields += ['lo_state_seqs', 'lo_action_seqs']
 
-        if self.use_long:
-            self.lo_state_seqs = []
-            self.lo_action_seqs = []
+        if self.use_ring:
+            self.cursor = 0  # index the next transition will be written to
+            self.n_stored = 0
+            # write count at which each slot was last written, to spot slots rewritten since a batch was sampled
+            self.n_writes = 0
+            self.generations = np.zeros(self.buffer_size, dtype=np.int64)
+            for field in self.fields:
+                setattr(self, field, None)
+        else:
+            for field in self.fields:
+                setattr(self, field, [])
+
+    def _layout(self, field: str, example):
+        """
+        Returns (shape, dtype) of the storage array for one field:
+        shaped like 'example' plus a leading buffer dimension
+        """
+        example = np.asarray(example)
+        if self.storage_dtype is not None:
+            if field == 'done_flags':
+                # 8 flags per byte
+                return ((self.buffer_size + 7) // 8, ), np.dtype(np.uint8)
+            if field == 'rewards':
+                return (self.buffer_size, ), np.dtype(np.float32)
+            if field in self.COMPACT_FIELDS:
+                return (self.buffer_size,
+                        *example.shape), np.dtype(self.storage_dtype)
+
+        # rewards may arrive as python ints (e.g. cartpole), so don't let the first one decide
+        dtype = {
+            'rewards': np.float64,
+            'discounts': np.float64,
+            'done_flags': np.bool_
+        }.get(field, example.dtype)
+        return (self.buffer_size, *example.shape), np.dtype(dtype)
+
+    def _allocate(self, field: str, example):
+        """
+        Creates the storage array for one field
+        """
+        shape, dtype = self._layout(field, example)
+        return np.empty(shape, dtype=dtype)
 
     def add(self,
             state_before: List[float],
@@ -42,38 +150,136 @@ class ReplayBuffer():
             reward: float,
             done_flag: bool,
             lo_state_seq=None,
-            lo_action_seq=None):
+            lo_action_seq=None,
+            lo_seq_start=None,
+            stream: int = 0):
         """
         Add a new transition to the buffer
-        """
-        self.states_before.append(state_before)
-        self.actions.append(action)
-        self.states_after.append(state_after)
-        self.rewards.append(reward)
-        self.done_flags.append(done_flag)
 
-        if self.use_long:
+        'stream' tells apart transitions from different environments stepped side by side,
+        so that n-step returns don't mix them up
+        """
+        if self.use_long and self.trajectory_store is not None:
+            assert lo_seq_start is not None
+        elif self.use_long:
             assert lo_state_seq is not None
             assert lo_action_seq is not None
-            self.lo_state_seqs.append(lo_state_seq)
-            self.lo_action_seqs.append(lo_action_seq)
+
+        transition = dict(
+            states_before=state_before,
+            actions=action,
+            states_after=state_after,
+            rewards=reward,
+            done_flags=done_flag,
+            lo_state_seqs=lo_state_seq,
+            lo_action_seqs=lo_action_seq,
+            lo_seq_starts=lo_seq_start)
+
+        if self.n_step > 1:
+            pending = self.pending[stream]
+            pending.append(transition)
+            if done_flag:
+                # the episode is over, so all pending returns are as complete as they will get
+                while pending:
+                    self._store(self._n_step_transition(pending))
+                    pending.popleft()
+            elif len(pending) == self.n_step:
+                self._store(self._n_step_transition(pending))
+                pending.popleft()
+            return
+
+        self._store(transition)
+
+    def _n_step_transition(self, pending: deque):
+        """
+        Folds a pending window into one transition starting at its oldest entry
+        """
+        transition = dict(pending[0])
+        transition['rewards'] = sum(self.discount_factor**k * p['rewards']
+                                    for k, p in enumerate(pending))
+        transition['states_after'] = pending[-1]['states_after']
+        transition['done_flags'] = pending[-1]['done_flags']
+        transition['discounts'] = self.discount_factor**len(pending)
+        return transition
+
+    def _store(self, transition: dict):
+        """
+        Writes one (possibly n-step) transition into the buffer
+        """
+        if self.use_ring:
+            for field in self.fields:
+                if getattr(self, field) is None:
+                    setattr(self, field,
+                            self._allocate(field, transition[field]))
+                if field == 'done_flags' and self.storage_dtype is not None:
+                    self._set_done_bit(transition[field])
+                else:
+                    # copies, so later in-place changes to the inputs don't leak into the buffer
+                    getattr(self, field)[self.cursor] = transition[field]
+
+            if self.relabel_versions is not None:
+                self.relabel_versions[self.cursor] = -1  # new transition, nothing cached
+            self.n_writes += 1
+            self.generations[self.cursor] = self.n_writes
+
+            self.cursor = (self.cursor + 1) % self.buffer_size
+            self.n_stored = min(self.n_stored + 1, self.buffer_size)
+            return
+
+        for field in self.fields:
+            getattr(self, field).append(transition[field])
 
         if len(self.states_before) > self.buffer_size:
-            self.states_before.pop(0)
-            self.actions.pop(0)
-            self.states_after.pop(0)
-            self.rewards.pop(0)
-            self.done_flags.pop(0)
-            if self.use_long:
-                self.lo_state_seqs.pop(0)
-                self.lo_action_seqs.pop(0)
+            for field in self.fields:
+                getattr(self, field).pop(0)
+
+    def _set_done_bit(self, done_flag: bool):
+        byte, bit = divmod(self.cursor, 8)
+        mask = np.uint8(0x80 >> bit)  # same bit order as np.packbits
+        if done_flag:
+            self.done_flags[byte] |= mask
+        else:
+            self.done_flags[byte] &= ~mask
 
     def __len__(self):
         """
         Returns how many transitions are currently stored in the buffer
         """
+        if self.use_ring:
+            return self.n_stored
         return len(self.done_flags)
 
+    def _gather(self, pick):
+        """
+        Returns a dict of numpy arrays holding the transitions at indices 'pick'
+        """
+        if self.use_ring:
+            # fancy indexing does the whole gather in one go
+            batch = {
+                field: getattr(self, field)[pick]
+                for field in self.fields
+                if field != 'done_flags' or self.storage_dtype is None
+            }
+            if self.storage_dtype is not None:
+                batch['done_flags'] = (
+                    (self.done_flags[pick // 8] >> (7 - pick % 8)) & 1).astype(
+                        np.bool_)
+                for field in self.COMPACT_FIELDS + ['rewards']:
+                    if field in batch:
+                        batch[field] = batch[field].astype(np.float64)
+        else:
+            batch = {
+                field: np.array([getattr(self, field)[p] for p in pick])
+                for field in self.fields
+            }
+
+        if self.trajectory_store is not None and self.use_long:
+            batch['lo_state_seqs'], batch[
+                'lo_action_seqs'] = self.trajectory_store.gather(
+                    batch.pop('lo_seq_starts'))
+
+        return batch
+
     def sample_batch(self):  #-> ReplayBatch:
         """
         Returns a batch of transtions sampled from the buffer
@@ -82,48 +288,50 @@ class ReplayBuffer():
         b_size = self.batch_size if len(self) > self.batch_size else len(self)
         # Samples are chosen without replacement
         pick = np.random.choice(len(self), size=b_size, replace=False)
-        sb = []
-        ac = []
-        sa = []
-        rw = []
-        df = []
-
-        for p in pick:
-            sb.append(self.states_before[p])
-            ac.append(self.actions[p])
-            sa.append(self.states_after[p])
-            rw.append(self.rewards[p])
-            df.append(self.done_flags[p])
-
-        sb = np.array(sb)
-        ac = np.array(ac)
-        sa = np.array(sa)
-        rw = np.array(rw)
-        df = np.array(df)
-
-        if self.use_long:
-            lss = []
-            las = []
-
-            for p in pick:
-                lss.append(self.lo_state_seqs[p])
-                las.append(self.lo_action_seqs[p])
-
-            lss = np.array(lss)
-            las = np.array(las)
-
-            return ReplayBatchLong(
-                states_before=sb,
-                actions=ac,
-                states_after=sa,
-                rewards=rw,
-                done_flags=df,
-                lo_state_seqs=lss,
-                lo_action_seqs=las)
-
-        return ReplayBatch(
-            states_before=sb,
-            actions=ac,
-            states_after=sa,
-            rewards=rw,
-            done_flags=df)
+
+        batch = self._gather(pick)
+        if self.relabel_cache_staleness is not None:
+            batch['indices'] = pick
+            batch['generations'] = self.generations[pick]
+
+        return batch_tuple(batch)
+
+    def rewritten(self, indices, generations):
+        """
+        Mask of the slots at 'indices' that have been overwritten since they were sampled with 'generations'
+        (e.g. while a prefetched batch waited to be trained on)
+        """
+        return self.generations[indices] != generations
+
+    def cached_relabels(self, indices, version: int, generations=None):
+        """
+        Returns the cached relabelled actions of the transitions at 'indices', and a mask of those
+        that need relabelling again: never relabelled, relabelled more than
+        'relabel_cache_staleness' lo policy versions before 'version', or (given the 'generations'
+        they were sampled with) whose slot now holds another transition
+        """
+        if self.relabel_versions is None:
+            return None, np.ones(len(indices), dtype=np.bool_)
+        versions = self.relabel_versions[indices]
+        stale = (versions < 0) | (version - versions >
+                                  self.relabel_cache_staleness)
+        if generations is not None:
+            stale |= self.rewritten(indices, generations)
+        return self.relabelled_actions[indices], stale
+
+    def cache_relabels(self, indices, relabelled_actions, version: int, generations=None):
+        """
+        Remembers the relabelled actions of the transitions at 'indices', computed under lo policy 'version'.
+        Given the 'generations' the transitions were sampled with, slots rewritten since then are skipped:
+        the relabelled action belongs to the transition that was there before
+        """
+        if self.relabel_versions is None:
+            self.relabelled_actions = np.empty(
+                (self.buffer_size, *relabelled_actions.shape[1:]))
+            self.relabel_versions = np.full(
+                self.buffer_size, -1, dtype=np.int64)
+        if generations is not None:
+            keep = ~self.rewritten(indices, generations)
+            indices, relabelled_actions = indices[keep], relabelled_actions[keep]
+        self.relabelled_actions[indices] = relabelled_actions
+        self.relabel_versions[indices] = version
@@ -0,0 +1,42 @@
+import tensorflow as tf
+
+
+class TargetUpdater():
+    def __init__(self,
+                 behaviour_models: list,
+                 target_models: list,
+                 tau: float = 0.001,
+                 soft_every: int = 1,
+                 hard_every: int = None):
+        """
+        Updates target networks from their behaviour networks with assign ops built once here,
+        so weights never leave the session.
+
+        step() is called once per learner step. Every 'soft_every' steps the targets get a Polyak
+        update (target = tau * behaviour + (1 - tau) * target), and every 'hard_every' steps
+        they become exact copies instead. Either can be None to switch it off.
+        """
+        self.soft_every = soft_every
+        self.hard_every = hard_every
+        self.n_steps = 0
+
+        behaviour_weights = [w for m in behaviour_models for w in m.weights]
+        target_weights = [w for m in target_models for w in m.weights]
+
+        self.soft_update_op = tf.group(*[
+            t.assign(tau * b + (1 - tau) * t)
+            for b, t in zip(behaviour_weights, target_weights)
+        ])
+        self.hard_update_op = tf.group(
+            *[t.assign(b) for b, t in zip(behaviour_weights, target_weights)])
+
+    def step(self):
+        """
+        Counts a learner step and runs whichever update is due, if any
+        """
+        self.n_steps += 1
+        session = tf.keras.backend.get_session()
+        if self.hard_every is not None and self.n_steps % self.hard_every == 0:
+            session.run(self.hard_update_op)
+        elif self.soft_every is not None and self.n_steps % self.soft_every == 0:
+            session.run(self.soft_update_op)
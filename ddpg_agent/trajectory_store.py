@@ -0,0 +1,115 @@
+import numpy as np
+import json
+import os
+
+
+class TrajectoryStore():
+    def __init__(self, capacity: int, seq_len: int, state_shape: tuple,
+                 action_shape: tuple, dtype=np.float64):
+        """
+        Ring of low-level (state, action) steps shared by all high-level transitions.
+
+        A high-level transition only keeps the absolute step index at which its
+        sequence of 'seq_len' low-level steps starts; gather() turns a batch of such
+        indices back into (batch, seq_len, ...) arrays.
+
+        Only complete sequences are written (see append_sequences()), so the ring holds
+        back-to-back sequences even when several environments record theirs side by side,
+        and 'capacity' steps cover capacity // seq_len high-level transitions.
+
+        Steps are stored as 'dtype' (e.g. np.float32 to halve the memory) and upcast to float64 by gather().
+        """
+        self.capacity = capacity
+        self.seq_len = seq_len
+        self.states = np.empty((capacity, *state_shape), dtype=dtype)
+        self.actions = np.empty((capacity, *action_shape), dtype=dtype)
+        self.total = 0  # number of steps appended so far (absolute index of the next step)
+        self.counters = None  # mapped copy of 'total' once persisted
+
+    def persist(self, store_dir: str):
+        """
+        Moves the store into numpy.memmap files under 'store_dir' (see MemmapReplayBuffer), so that
+        the start indices kept by a persisted replay buffer still point at their sequences after a restart.
+
+        If 'store_dir' already holds a store of the same layout, it is reopened as it was left
+        (this store must still be empty then).
+        """
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        layout = {
+            'capacity': self.capacity,
+            'seq_len': self.seq_len,
+            'fields': {
+                field: {'shape': list(getattr(self, field).shape),
+                        'dtype': getattr(self, field).dtype.str}
+                for field in ('states', 'actions')
+            }
+        }
+        layout_path = os.path.join(store_dir, 'layout.json')
+        counters_path = os.path.join(store_dir, 'counters.dat')
+        if os.path.exists(layout_path):
+            with open(layout_path, 'r') as fh:
+                assert json.load(fh) == layout, \
+                    f'{store_dir} holds a trajectory store with a different layout'
+            assert self.total == 0, 'only an empty trajectory store can reopen a persisted one'
+            mode = 'r+'
+        else:
+            with open(layout_path, 'w') as fh:
+                json.dump(layout, fh)
+            mode = 'w+'
+
+        for field, entry in layout['fields'].items():
+            mapped = np.memmap(
+                os.path.join(store_dir, field + '.dat'),
+                dtype=np.dtype(entry['dtype']),
+                mode=mode,
+                shape=tuple(entry['shape']))
+            if mode == 'w+':
+                mapped[:] = getattr(self, field)
+            setattr(self, field, mapped)
+
+        self.counters = np.memmap(counters_path, dtype=np.int64, mode=mode, shape=(1, ))
+        if mode == 'w+':
+            self.counters[0] = self.total
+        self.total = int(self.counters[0])
+
+    def flush(self):
+        """
+        Writes any dirty pages of a persisted store back to disk
+        """
+        if self.counters is not None:
+            self.states.flush()
+            self.actions.flush()
+            self.counters.flush()
+
+    def append_sequences(self, states, actions):
+        """
+        Writes complete sequences back to back and returns their absolute start indices
+
+        states : np.array: (n, seq_len, *state_shape)
+        actions : np.array: (n, seq_len, *action_shape)
+        """
+        n = states.shape[0]
+        starts = self.total + self.seq_len * np.arange(n, dtype=np.int64)
+        pick = (starts[:, None] + np.arange(self.seq_len)) % self.capacity
+        self.states[pick] = states
+        self.actions[pick] = actions
+        self.total += n * self.seq_len
+        if self.counters is not None:
+            # only advance the persisted total once the steps themselves are written
+            self.counters[0] = self.total
+        return starts
+
+    def gather(self, starts):
+        """
+        Returns the (state, action) sequences starting at the absolute indices 'starts'
+        as arrays of shape (len(starts), seq_len, ...)
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        assert np.all(starts >= self.total - self.capacity), \
+            'trajectory has already been overwritten - capacity is too small for the replay buffer'
+        assert np.all(starts + self.seq_len <= self.total), \
+            'trajectory was never written to this store'
+        pick = (starts[:, None] + np.arange(self.seq_len)) % self.capacity
+        return self.states[pick].astype(np.float64), self.actions[pick].astype(
+            np.float64)
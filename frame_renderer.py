@@ -0,0 +1,141 @@
+import subprocess
+import numpy as np
+
+
+def fill_polygon(frame, points, color):
+    """
+    Fills the polygon with vertices 'points' (pixel coordinates, (x, y) with y pointing down) in the
+    (height, width, 3) uint8 'frame', testing all the pixels of its bounding box against all its
+    edges at once (even-odd rule, so any simple polygon works, convex or not)
+    """
+    points = np.asarray(points, dtype=np.float64)
+    height, width = frame.shape[:2]
+    x0, y0 = np.maximum(np.floor(points.min(axis=0)).astype(int), 0)
+    x1 = min(int(np.ceil(points[:, 0].max())), width)
+    y1 = min(int(np.ceil(points[:, 1].max())), height)
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    # pixel centres (1, 1, w) and (1, h, 1) against edges (n_edges, 1, 1)
+    px = (np.arange(x0, x1) + 0.5)[None, None, :]
+    py = (np.arange(y0, y1) + 0.5)[None, :, None]
+    a = points[:, None, None, :]
+    b = np.roll(points, -1, axis=0)[:, None, None, :]
+    ax, ay, bx, by = a[..., 0], a[..., 1], b[..., 0], b[..., 1]
+
+    crosses = (ay > py) != (by > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = ax + (py - ay) * (bx - ax) / (by - ay)
+    inside = np.logical_xor.reduce(crosses & (px < x_cross), axis=0)
+
+    frame[y0:y1, x0:x1][inside] = np.round(np.asarray(color[:3]) * 255)
+
+
+def fill_circle(frame, centre, radius, color):
+    height, width = frame.shape[:2]
+    cx, cy = centre
+    x0, y0 = max(int(cx - radius), 0), max(int(cy - radius), 0)
+    x1, y1 = min(int(np.ceil(cx + radius)) + 1, width), min(int(np.ceil(cy + radius)) + 1, height)
+    if x0 >= x1 or y0 >= y1:
+        return
+    px = np.arange(x0, x1)[None, :] + 0.5
+    py = np.arange(y0, y1)[:, None] + 0.5
+    inside = (px - cx)**2 + (py - cy)**2 <= radius**2
+    frame[y0:y1, x0:x1][inside] = np.round(np.asarray(color[:3]) * 255)
+
+
+def transform(points, translation=(0, 0), rotation=0., scale=(1, 1)):
+    """
+    Scales, then rotates (counter-clockwise, radians), then translates 'points' (n, 2),
+    the same order as gym's rendering.Transform
+    """
+    points = np.asarray(points, dtype=np.float64) * scale
+    c, s = np.cos(rotation), np.sin(rotation)
+    return points @ np.array([[c, s], [-s, c]]) + translation
+
+
+class Rasterizer():
+    def __init__(self, width: int, height: int):
+        """
+        Headless replacement for gym's rendering.Viewer (no window, no OpenGL): draws straight into
+        self.frame, a (height, width, 3) uint8 array. Coordinates are world coordinates within the
+        bounds given to set_bounds() (y pointing up), colours are (r, g, b) in [0, 1].
+        """
+        self.width = width
+        self.height = height
+        self.frame = np.zeros((height, width, 3), dtype=np.uint8)
+        self.set_bounds(0, width, 0, height)
+
+    def set_bounds(self, left, right, bottom, top):
+        self.left, self.bottom = left, bottom
+        self.scale_x = self.width / (right - left)
+        self.scale_y = self.height / (top - bottom)
+
+    def to_pixels(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        return np.stack([(points[:, 0] - self.left) * self.scale_x,
+                         self.height - (points[:, 1] - self.bottom) * self.scale_y], axis=1)
+
+    def clear(self, color=(1, 1, 1)):
+        self.frame[:] = np.round(np.asarray(color[:3]) * 255)
+
+    def draw_polygon(self, points, color):
+        fill_polygon(self.frame, self.to_pixels(points), color)
+
+    def draw_polyline(self, points, color, linewidth=1):
+        """
+        Every segment becomes a quad 'linewidth' pixels wide
+        """
+        points = self.to_pixels(points)
+        for p, q in zip(points[:-1], points[1:]):
+            direction = q - p
+            length = np.hypot(*direction)
+            if length == 0:
+                continue
+            normal = np.array([-direction[1], direction[0]]) / length * max(linewidth, 1) / 2
+            fill_polygon(self.frame, [p + normal, q + normal, q - normal, p - normal], color)
+
+    def draw_circle(self, centre, radius, color):
+        fill_circle(self.frame, self.to_pixels([centre])[0], radius * self.scale_x, color)
+
+    def get_frame(self):
+        return np.copy(self.frame)
+
+
+def tile_frames(frames, n_columns: int = None):
+    """
+    Puts a batch of frames (n, height, width, 3) side by side in a grid, as a single frame
+    """
+    n, height, width = frames.shape[:3]
+    n_columns = int(np.ceil(np.sqrt(n))) if n_columns is None else n_columns
+    n_rows = int(np.ceil(n / n_columns))
+    grid = np.zeros((n_rows * height, n_columns * width, 3), dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        row, column = divmod(i, n_columns)
+        grid[row * height:(row + 1) * height, column * width:(column + 1) * width] = frame
+    return grid
+
+
+class VideoWriter():
+    def __init__(self, path: str, width: int, height: int, fps: int = 50):
+        """
+        Streams (height, width, 3) uint8 frames to a video file, through an ffmpeg process
+        (the ffmpeg executable has to be installed)
+        """
+        self.process = subprocess.Popen(
+            ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+             '-s', f'{width}x{height}', '-r', str(fps), '-i', '-', '-pix_fmt', 'yuv420p', path],
+            stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
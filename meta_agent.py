@@ -1,5 +1,6 @@
 from agent import BaseAgent, HiAgent
 import gym
+from ddpg_agent.trajectory_store import TrajectoryStore
 import numpy as np
 from copy import deepcopy
 import agent
@@ -17,27 +18,44 @@ class MetaAgent(BaseAgent):
                  lo_agent_cls=BaseAgent,
                  models_dir=None,
                  c=40,
-                 hi_action_space=None):
+                 hi_action_space=None,
+                 hi_buffer_size=20000,
+                 relabel_cache_staleness=None,
+                 storage_dtype=None,
+                 n_envs=1):
         # note, this will not work if initialised with
         # default parameters!
         # high- and lo_agent need to be explicitly set
 
         super().__init__(state_space, action_space)
 
+        # everything below is kept per environment (one row each),
+        # so that n_envs environments can be stepped side by side
+        self.n_envs = n_envs
         self.c = c  # number of time steps between high level actions
-        self.t = 0  # step counter (resets after every c steps)
+        self.t = np.zeros(n_envs, dtype=np.int64)  # step counters (reset after every c steps)
 
-        self.hi_rewards = 0  # collects rewads for HL agent, applied every c steps
+        self.hi_rewards = np.zeros(n_envs)  # collects rewads for HL agent, applied every c steps
 
-        self.hi_state = None  # state in which HL agent last took an action
+        self.hi_state = np.zeros((n_envs, *state_space.shape))  # state in which HL agent last took an action
 
         self.hi_action = None  # HL agent's actions in (-1, 1) space (direct from network)
         self.goal = None  # HL agent's actions translated to (low, high) space
         self.lo_reward = None  # so that this can be retrieved for score display
 
-        # these will record sequences necessary for off-policy relabelling later
-        self.lo_action_seq = np.empty((c, *action_space.shape))
-        self.lo_state_seq = np.empty((c, *state_space.shape))
+        # the c (state, action) steps of the sequence each environment is currently recording...
+        self.lo_state_seqs = np.zeros((n_envs, c, *state_space.shape))
+        self.lo_action_seqs = np.zeros((n_envs, c, *action_space.shape))
+
+        # ...are moved here once complete, for off-policy relabelling later
+        # the HL agent's transitions only keep the index where their sequence starts
+        # with a 'storage_dtype' (e.g. np.float32), the steps and both agents' replay buffers are stored compactly
+        self.trajectory_store = TrajectoryStore(
+            capacity=(hi_buffer_size + n_envs) * c,
+            seq_len=c,
+            state_shape=state_space.shape,
+            action_shape=action_space.shape,
+            dtype=np.float64 if storage_dtype is None else storage_dtype)
 
         self.lo_state_space = gym.spaces.Box(
             low=np.concatenate([state_space.low, state_space.low]),
@@ -50,6 +68,9 @@ class MetaAgent(BaseAgent):
             #clipping!
             self.hi_action_space = hi_action_space
 
+        self.hi_action = np.zeros((n_envs, *self.hi_action_space.shape))
+        self.goal = np.zeros((n_envs, *self.hi_action_space.shape))
+
         # figure out if any of the states are angles in (-pi, pi)
         # so that we can calculate distances between them properly in the intrinsic reward function
         # this is an example of "artifical intelligence"
@@ -63,6 +84,10 @@ class MetaAgent(BaseAgent):
                 state_space=state_space,
                 action_space=self.hi_action_space,
                 use_long_buffer=True,
+                buffer_size=hi_buffer_size,
+                trajectory_store=self.trajectory_store,
+                relabel_cache_staleness=relabel_cache_staleness,
+                storage_dtype=storage_dtype,
                 exploration_mode="rough_explore",
                 exploration_magnitude=0.7,
                 exploration_decay=0.99995,
@@ -70,18 +95,21 @@ class MetaAgent(BaseAgent):
                 discount_factor=0.99,
                 n_units=[256, 128, 64],
                 weights_stdev=0.001,
+                numpy_inference=True,
                 c=c)
 
             # low level agent's states will be (state, goal) concatenated
             self.lo_agent = lo_agent_cls.new_trainable_agent(
                 state_space=self.lo_state_space,
                 action_space=action_space,
+                storage_dtype=storage_dtype,
                 exploration_mode="gaussian",
                 exploration_magnitude=2.0,
                 exploration_decay=0.9999995,
                 discount_factor=0.95,
                 n_units=[128, 64],
                 weights_stdev=0.001,
+                numpy_inference=True,
             )
         else:
             self.hi_agent = hi_agent_cls.load_pretrained_agent(
@@ -89,18 +117,27 @@ class MetaAgent(BaseAgent):
                 state_space=state_space,
                 action_space=self.hi_action_space,
                 c=c,
-                exploration_mode="no_exploration")
+                exploration_mode="no_exploration",
+                numpy_inference=True)
 
             self.lo_agent = lo_agent_cls.load_pretrained_agent(
                 filepath=models_dir + '/lo_agent',
                 state_space=self.lo_state_space,
                 action_space=action_space,
-                exploration_mode="no_exploration")
+                exploration_mode="no_exploration",
+                numpy_inference=True)
 
         # we won't need networks etc here
 
-    def reset_clock(self):
-        self.t = 0
+    def reset_clock(self, mask=None):
+        """
+        Starts a new episode in the environments selected by the boolean 'mask' (default: all).
+        Their unfinished sequences will never be used by the HL agent.
+        """
+        if mask is None:
+            mask = np.ones(self.n_envs, dtype=bool)
+        self.t[mask] = 0
+        self.hi_rewards[mask] = 0
 
     @staticmethod
     def goal_transition(goal, state, next_state):
@@ -126,8 +163,9 @@ class MetaAgent(BaseAgent):
         normalized_differences = np.abs(difference) / (
             self.hi_action_space.high - self.hi_action_space.low)
 
-        final_reward = np.linalg.norm(1 - normalized_differences) / np.sqrt(
-            state.shape[1])
+        # one reward per row (environment)
+        final_reward = np.linalg.norm(
+            1 - normalized_differences, axis=1) / np.sqrt(state.shape[1])
 
         return final_reward
 
@@ -136,37 +174,41 @@ class MetaAgent(BaseAgent):
         self.lo_agent.modify_exploration_magnitude(factor=factor, mode=mode)
 
     def act(self, state):
+        """
+        state.shape: (n_envs, *state_space.shape)
+        """
 
-        # is it time for a high-level action?
-        if self.t % self.c == 0:
-            self.t = 0
+        # is it time for a high-level action? (in which environments?)
+        due = self.t % self.c == 0
+        if due.any():
+            self.t[due] = 0
 
-            # HL agent picks a new state from space and sets it as LL's goal
-            self.hi_action = self.hi_agent.act(state)  #this will be in (-1
-            self.goal = self.hi_agent.scale_action(self.hi_action)
+            # HL agent picks new states from space and sets them as LL's goals
+            # (a single forward pass for all the environments that are due)
+            self.hi_action[due] = self.hi_agent.act(state[due])  #this will be in (-1
+            self.goal[due] = self.hi_agent.scale_action(self.hi_action[due])
 
             # save for later training
-            self.hi_state = state
+            self.hi_state[due] = state[due]
 
         # action in environment comes from low level agent
-        goal_broadcast = np.broadcast_to(
-            self.goal,
-            state.shape)  #add a batch dimension just in case it's not there
-
         lo_action = self.lo_agent.act(
-            state=np.concatenate([state, goal_broadcast], axis=1))
+            state=np.concatenate([state, self.goal], axis=1))
 
         # This is just useful for training, right? Should this be inside train()?
         # No. Because we want the unscaled action. Is that it?
-        self.lo_state_seq[self.t] = state
-        self.lo_action_seq[self.
-                           t] = lo_action  #unscaled - still tanh space. good!
+        envs = np.arange(self.n_envs)
+        self.lo_state_seqs[envs, self.t] = state
+        self.lo_action_seqs[envs, self.t] = lo_action  #unscaled - still tanh space. good!
 
         self.t += 1
 
         return lo_action
 
-    def train(self, state, action, reward: float, next_state, done: bool):
+    def train(self, state, action, reward, next_state, done):
+        """
+        reward and done are floats / bools for a single environment, arrays of n_envs otherwise
+        """
 
         # accumulate rewards for HL agent
         self.hi_rewards += reward
@@ -197,22 +239,27 @@ class MetaAgent(BaseAgent):
             next_state=np.concatenate([next_state, next_goal], axis=1),
             done=lo_done)
 
-        # is it time to train the HL agent?
+        # is it time to train the HL agent? (in which environments?)
         hi_loss = None
-        if self.t % self.c == 0:
+        if lo_done.any():
+            # their sequences are complete now, so they go into the store
+            lo_seq_starts = self.trajectory_store.append_sequences(
+                self.lo_state_seqs[lo_done], self.lo_action_seqs[lo_done])
+
             hi_loss, _ = self.hi_agent.train(
-                state=self.hi_state,
-                action=self.hi_action,  #(-1, 1)
-                reward=self.hi_rewards,
-                next_state=next_state,
-                done=done,
-                relabeller=self.relabel_hi_action,
-                lo_state_seq=self.lo_state_seq,
-                lo_action_seq=self.lo_action_seq,
-                lo_current_policy=self.lo_agent.act)
+                state=self.hi_state[lo_done],
+                action=self.hi_action[lo_done],  #(-1, 1)
+                reward=self.hi_rewards[lo_done],
+                next_state=next_state[lo_done],
+                done=np.broadcast_to(done, lo_done.shape)[lo_done],
+                relabeller=self.relabel_hi_actions,
+                lo_seq_start=lo_seq_starts,
+                lo_current_policy=self.lo_agent.policy,
+                lo_policy_version=self.lo_agent.n_train_steps,
+                streams=np.flatnonzero(lo_done))
 
             # reset this
-            self.hi_rewards = 0
+            self.hi_rewards[lo_done] = 0
 
         return lo_loss, hi_loss
 
@@ -220,6 +267,30 @@ class MetaAgent(BaseAgent):
     def relabel_hi_action(orig_hi_action, goal_scaler, lo_state_seq,
                           lo_action_seq, lo_current_policy):
         """
+        single-transition version of relabel_hi_actions()
+
+        Parameters
+        ----------
+
+        orig_hi_action : np.array: (*state.shape) in tanh space
+
+        lo_state_seq : np.array: (c, *state.shape)
+
+        lo_action_seq : np.array: (c, *action.shape)
+
+        lo_current_policy : func: state -> action
+        """
+        return MetaAgent.relabel_hi_actions(
+            orig_hi_actions=np.expand_dims(orig_hi_action, axis=0),
+            goal_scaler=goal_scaler,
+            lo_state_seqs=np.expand_dims(lo_state_seq, axis=0),
+            lo_action_seqs=np.expand_dims(lo_action_seq, axis=0),
+            lo_current_policy=lo_current_policy)[0]
+
+    @staticmethod
+    def relabel_hi_actions(orig_hi_actions, goal_scaler, lo_state_seqs,
+                           lo_action_seqs, lo_current_policy):
+        """
         this will be used internally by the HiAgent in its train() routine
         where, at some point, we should have
             if relabel: 
@@ -227,26 +298,25 @@ class MetaAgent(BaseAgent):
             else: 
                 transition_tuple = ...
 
-        Note: this currently only works with individual tuples, not minibatches of them
+        works on a whole minibatch at once: the candidate goals of every transition
+        are scored with a single call to lo_current_policy
 
         Parameters
         ----------
 
-        orig_hi_action : np.array: (*state.shape) in tanh space
+        orig_hi_actions : np.array: (batch, *state.shape) in tanh space
 
-        lo_state_seq : np.array: (c, *state.shape)
-            array containing the c states visited by the LoAgent since the last HiAgent training step
+        lo_state_seqs : np.array: (batch, c, *state.shape)
+            for each transition, the c states visited by the LoAgent during that HiAgent step
         
-        lo_action_seq : np.array: (c, *action.shape)
-            array containing the c actions taken by the LoAgent since the last HiAgent training step
+        lo_action_seqs : np.array: (batch, c, *action.shape)
+            for each transition, the c actions taken by the LoAgent during that HiAgent step
             (again, tanh space)
 
         lo_current_policy : func: state -> action
-            the act() function of the LoAgent (supplied by a MetaAgent)        
+            the LoAgent's policy without exploration (supplied by a MetaAgent)        
         """
-
-        # get variance from observed states
-        stdev_goal = np.std(lo_state_seq, axis=0)  #in future - cov instead?
+        batch_size, c = lo_state_seqs.shape[:2]
 
         # eight candidate goals sampled randomly from a Gaussian centered at s_t+c − s_t
         # i.e. around the original goal
@@ -254,16 +324,16 @@ class MetaAgent(BaseAgent):
         n_candidate_hi_acts = 8
 
         candidate_hi_actions = np.random.normal(
-            loc=orig_hi_action,
+            loc=np.expand_dims(orig_hi_actions, axis=1),
             scale=(1 / 3),  #since we're in (1/1) space...
-            size=(n_candidate_hi_acts, *orig_hi_action.shape))
+            size=(batch_size, n_candidate_hi_acts, *orig_hi_actions.shape[1:]))
 
         # also include the original hi_action gt
         candidate_hi_actions = np.concatenate([
             candidate_hi_actions,
-            np.expand_dims(orig_hi_action, axis=0),
+            np.expand_dims(orig_hi_actions, axis=1),
         ],
-                                              axis=0)
+                                              axis=1)
 
         candidate_goals = goal_scaler(candidate_hi_actions)
 
@@ -271,39 +341,48 @@ class MetaAgent(BaseAgent):
         # one corresponding to the path taken: s_t+c - s_t
         candidate_goals = np.concatenate([
             candidate_goals,
-            np.expand_dims(lo_state_seq[-1] - lo_state_seq[0], axis=0)
+            np.expand_dims(
+                lo_state_seqs[:, -1] - lo_state_seqs[:, 0], axis=1)
         ],
-                                         axis=0)
-
-        lo_policy_likelihoods = []
-
-        for g in range(n_candidate_hi_acts + 2):
-
-            lo_state_deltas = np.subtract(lo_state_seq, lo_state_seq[0])
-
-            goal_over_time = np.broadcast_to(
-                candidate_goals[g], shape=lo_state_seq.shape) - lo_state_deltas
-
-            # transform the (state) c-tuple into a (state, goal) c-tuple
-            lo_stategoal_seq = np.concatenate([lo_state_seq, goal_over_time],
-                                              axis=1)
-
-            # what actions would the current LoAgent take, given goal g?
-            lo_current_actions = lo_current_policy(lo_stategoal_seq)
+                                         axis=1)
+        n_candidates = candidate_goals.shape[1]
+
+        # (batch, candidates, c, state) goals, as transitioned along each path
+        lo_state_deltas = lo_state_seqs - lo_state_seqs[:, :1]
+        goal_over_time = np.expand_dims(
+            candidate_goals, axis=2) - np.expand_dims(
+                lo_state_deltas, axis=1)
+
+        # transform the (state) c-tuples into (state, goal) c-tuples
+        lo_stategoal_seqs = np.concatenate([
+            np.broadcast_to(
+                np.expand_dims(lo_state_seqs, axis=1), goal_over_time.shape),
+            goal_over_time
+        ],
+                                           axis=3)
 
-            # how far do they diverge from the actual actions, given original goal?
-            lo_sq_difference = np.linalg.norm(
-                lo_action_seq - lo_current_actions, axis=1)**2
+        # what actions would the current LoAgent take, given each goal? (one forward pass)
+        lo_current_actions = lo_current_policy(
+            lo_stategoal_seqs.reshape((-1, lo_stategoal_seqs.shape[-1])))
+        lo_current_actions = lo_current_actions.reshape(
+            (batch_size, n_candidates, c, -1))
 
-            lo_neg_sum_sq_diff = -1 * np.sum(lo_sq_difference, axis=0)
+        # how far do they diverge from the actual actions, given original goal?
+        lo_sq_difference = np.sum(
+            (np.expand_dims(lo_action_seqs, axis=1) - lo_current_actions)**2,
+            axis=3)
 
-            lo_policy_likelihoods.append(lo_neg_sum_sq_diff)
+        lo_policy_likelihoods = -1 * np.sum(lo_sq_difference, axis=2)
 
         # find the (approximate) goal that maximises the likelihood of the observed actions
-        likeliest_goal = np.argmax(lo_policy_likelihoods)
+        likeliest_goals = np.argmax(lo_policy_likelihoods, axis=1)
 
-        return candidate_goals[likeliest_goal]
+        return candidate_goals[np.arange(batch_size), likeliest_goals]
 
     def save_model(self, filepath: str):
         self.hi_agent.save_model(filepath + '/hi_agent')
         self.lo_agent.save_model(filepath + '/lo_agent')
+
+    def close(self):
+        self.hi_agent.close()
+        self.lo_agent.close()
@@ -0,0 +1,114 @@
+import numpy as np
+import math
+from functools import lru_cache
+
+
+def _t_two_sided(t, df: int) -> float:
+    """
+    P(|T| < t) for a Student-t variable with integer df degrees of freedom
+    (closed form, Abramowitz & Stegun 26.7.3 and 26.7.4)
+    """
+    theta = math.atan(t / math.sqrt(df))
+    s, c2 = math.sin(theta), math.cos(theta)**2
+    if df % 2 == 0:
+        term, total = 1., 1.
+        for k in range(2, df, 2):
+            term *= c2 * (k - 1) / k
+            total += term
+        return s * total
+    total = theta
+    if df > 1:
+        term, series = 1., 1.
+        for k in range(3, df, 2):
+            term *= c2 * (k - 1) / k
+            series += term
+        total += s * math.cos(theta) * series
+    return 2 / math.pi * total
+
+
+@lru_cache(maxsize=None)
+def t_quantile(p: float, df: int) -> float:
+    """
+    The t with P(T < t) = p (p > 0.5) for a Student-t variable with df degrees of freedom, by bisection
+    """
+    target = 2 * p - 1
+    low, high = 0., 1.
+    while _t_two_sided(high, df) < target:
+        low, high = high, 2 * high
+    for _ in range(100):
+        mid = (low + high) / 2
+        if _t_two_sided(mid, df) < target:
+            low = mid
+        else:
+            high = mid
+    return high
+
+
+class SolvedCheck:
+
+    def __init__(self, min_score, max_episodes=100, criterion='all', confidence=0.95, min_episodes=5):
+        """
+        Decides whether an agent solves a problem, playing as few test episodes as possible.
+
+        criterion='all': every one of max_episodes episodes must score more than min_score,
+        so the first failure decides.
+        criterion='mean': the mean score over max_episodes episodes must reach min_score.
+        From min_episodes episodes on, the check stops as soon as a Student-t confidence interval of
+        the mean lies entirely above or below min_score (the error probability 1 - confidence is split
+        over all these looks); otherwise the mean of all max_episodes decides. Like any t interval, this
+        assumes roughly normal scores, and the scores must come in a fixed episode order (not in the order
+        episodes finish, which favours the short ones).
+        """
+        assert criterion in ('all', 'mean')
+        self.min_score = min_score
+        self.max_episodes = max_episodes
+        self.criterion = criterion
+        self.min_episodes = min(max(min_episodes, 2), max_episodes)
+
+        n_looks = self.max_episodes - self.min_episodes + 1
+        self.quantile = 1 - (1 - confidence) / (2 * n_looks)
+
+        self.scores = []
+        self.solved = None  # None until decided
+
+    def update(self, score) -> bool:
+        """
+        Takes the score of one more episode, returns whether the outcome is decided
+        """
+        self.scores.append(score)
+        n = len(self.scores)
+
+        if self.criterion == 'all':
+            if score <= self.min_score:
+                self.solved = False
+            elif n >= self.max_episodes:
+                self.solved = True
+        else:
+            mean = np.mean(self.scores)
+            if n >= self.max_episodes:
+                self.solved = mean >= self.min_score
+            elif n >= self.min_episodes:
+                half_width = t_quantile(self.quantile, n - 1) * np.std(self.scores, ddof=1) / np.sqrt(n)
+                if mean - half_width >= self.min_score:
+                    self.solved = True
+                elif mean + half_width < self.min_score:
+                    self.solved = False
+
+        return self.solved is not None
+
+    def run(self, episodes) -> bool:
+        """
+        Consumes scores from the iterable 'episodes' until the outcome is decided, returns it
+        """
+        for score in episodes:
+            print(f'Episode {len(self.scores)} of at most {self.max_episodes}. score: {score}')
+            if self.update(score):
+                break
+        assert self.solved is not None, 'ran out of episodes before the outcome was decided'
+
+        neg = 'not ' if not self.solved else ' '
+        print(f'\nProblem{neg}solved.')
+        print(f'Mean score over {len(self.scores)} episodes: {np.mean(self.scores)}')
+        if self.criterion == 'all':
+            print(f'Failed episodes: {np.sum(np.array(self.scores) <= self.min_score)}')
+        return self.solved
@@ -0,0 +1,103 @@
+from agent import BaseAgent
+from teacher_agent.teachersmodel import TeachersModel
+from continuous_cartpole import cart_pole_reward
+import numpy as np
+
+
+class PlannerAgent(BaseAgent):
+    def __init__(self,
+        c,
+        state_space: 'Box'=None,
+        action_space: 'Box'=None,
+        horizon=None,
+        n_candidates=1000,
+        n_iterations=3,
+        n_elites=50,
+        reward_function=cart_pole_reward,
+        **kwargs
+        ):
+        """
+        High-level agent for the continuous cartpole that needs no training: for every state it plans
+        with the cross-entropy method on TeachersModel (exact dynamics), and sets the state reached
+        after c steps of the best plan as the goal (like TeacherAgent does with its brain).
+
+        Every iteration evaluates 'n_candidates' sequences of 'horizon' (default c) low-level actions
+        in a single batched rollout, then refits the sampling distribution to the 'n_elites' best ones.
+        n_iterations=1 is plain random shooting.
+        """
+        super().__init__(state_space, action_space)
+        self.explr_magnitude = 0
+        self.c = c
+        self.horizon = c if horizon is None else max(horizon, c)
+        self.n_candidates = n_candidates
+        self.n_iterations = n_iterations
+        self.n_elites = min(n_elites, n_candidates)
+        self.reward_function = reward_function
+        self.model = TeachersModel()
+
+    @classmethod
+    def new_trainable_agent(cls, **kwargs) -> 'PlannerAgent':
+        return PlannerAgent(**kwargs)
+
+    @classmethod
+    def load_pretrained_agent(cls, **kwargs) -> 'PlannerAgent':
+        return PlannerAgent(**kwargs)
+
+    def rollout(self, states, plans):
+        """
+        states: (N, 4), plans: (N, K, horizon) low-level actions in (-1, 1)
+        returns the total rewards (N, K) and the states after c steps (N, K, 4)
+        """
+        n, k = plans.shape[:2]
+        current = np.repeat(states, k, axis=0)
+        total_rewards = np.zeros(n * k)
+        for t in range(self.horizon):
+            current = self.model.step_batch(current, plans[:, :, t].reshape((-1, 1)))
+            total_rewards += self.reward_function(self.model, current)
+            if t == self.c - 1:
+                goal_states = current.reshape((n, k, -1))
+        return total_rewards.reshape((n, k)), goal_states
+
+    def plan(self, states):
+        """
+        The states reached after c steps of the best plan found for each of the states (N, 4)
+        """
+        n = states.shape[0]
+        mean = np.zeros((n, 1, self.horizon))
+        std = np.ones((n, 1, self.horizon))
+        best_rewards = np.full(n, -np.inf)
+        best_goals = np.copy(states)
+        for _ in range(self.n_iterations):
+            plans = np.clip(
+                np.random.normal(mean, std, size=(n, self.n_candidates, self.horizon)), -1, 1)
+            total_rewards, goal_states = self.rollout(states, plans)
+
+            # keep the best plan seen so far
+            best = np.argmax(total_rewards, axis=1)
+            improved = total_rewards[np.arange(n), best] > best_rewards
+            best_rewards[improved] = total_rewards[improved, best[improved]]
+            best_goals[improved] = goal_states[improved, best[improved]]
+
+            # refit the sampling distribution to the elites
+            elites = np.argpartition(-total_rewards, self.n_elites - 1, axis=1)[:, :self.n_elites]
+            elite_plans = np.take_along_axis(plans, elites[:, :, None], axis=1)
+            mean = elite_plans.mean(axis=1, keepdims=True)
+            std = elite_plans.std(axis=1, keepdims=True) + 1e-3
+        return best_goals
+
+    def act(self, state, explore=False):
+        assert not np.isnan(state).any()
+
+        final_state = self.plan(state)
+
+        diff_goal = (final_state - state) / self.action_space.high
+        return np.clip(diff_goal, -1, 1)
+
+    def train(self, **kwargs):
+        return 0, None
+
+    def save_model(self, filepath: str):
+        print('Planner agent. Nothing to save')
+
+    def modify_exploration_magnitude(self, factor, mode='increment'):
+        pass
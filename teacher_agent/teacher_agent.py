@@ -19,7 +19,8 @@ class TeacherAgent(BaseAgent):
         self.brain = DDPGAgent.load_pretrained_agent(
             state_space=state_space,
             action_space=action_space,
-            filepath='teacher_agent/teachersbrain')
+            filepath='teacher_agent/teachersbrain',
+            numpy_inference=True)
         self.model = TeachersModel()
 
 
@@ -34,10 +35,11 @@ class TeacherAgent(BaseAgent):
     def act(self, state, explore=False):
         assert not np.isnan(state).any()
 
+        # roll the model out c steps ahead for all the states at once
         final_state = np.copy(state)
         for t in range(self.c):
             action = self.brain.act(final_state)
-            final_state = self.model.step(state=final_state, action=action[0])
+            final_state = self.model.step_batch(final_state, action)
         
         diff_goal = (final_state - state) / self.action_space.high
         return diff_goal
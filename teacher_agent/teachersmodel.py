@@ -4,6 +4,7 @@ from gym import spaces, logger
 from gym.utils import seeding
 import numpy as np
 from copy import deepcopy
+from continuous_cartpole import cart_pole_dynamics
 
 class TeachersModel(gym.Env):
     metadata = {
@@ -45,26 +46,11 @@ class TeachersModel(gym.Env):
 
     def step(self, state, action):
         assert self.action_space.contains(action), "%r (%s) invalid"%(action, type(action))
-        x, x_dot, theta, theta_dot = state[0]
-        force = self.force_mag * action[0]
-        costheta = math.cos(theta)
-        sintheta = math.sin(theta)
-        temp = (force + self.polemass_length * theta_dot * theta_dot * sintheta) / self.total_mass
-        thetaacc = (self.gravity * sintheta - costheta* temp) / (self.length * (4.0/3.0 - self.masspole * costheta * costheta / self.total_mass))
-        xacc  = temp - self.polemass_length * thetaacc * costheta / self.total_mass
-        if self.kinematics_integrator == 'euler':
-            x  = x + self.tau * x_dot
-            x_dot = x_dot + self.tau * xacc
-            theta = theta + self.tau * theta_dot
-            theta_dot = theta_dot + self.tau * thetaacc
-        else: # semi-implicit euler
-            x_dot = x_dot + self.tau * xacc
-            x  = x + self.tau * x_dot
-            theta_dot = theta_dot + self.tau * thetaacc
-            theta = theta + self.tau * theta_dot
-        next_state = (x,x_dot,theta,theta_dot)
-
-        done =  x < -self.x_threshold or x > self.x_threshold
-        done = bool(done)
-        
-        return np.expand_dims(next_state, axis=0)
+        return self.step_batch(np.reshape(state, (1, 4)), np.reshape(action, (1, 1)))
+
+    def step_batch(self, states, actions):
+        """
+        Same as step(), for a whole batch: states (N, 4), actions (N, 1) -> next states (N, 4)
+        """
+        assert np.all(np.abs(actions) <= 1), "%r invalid"%(actions, )
+        return cart_pole_dynamics(self, states, actions)
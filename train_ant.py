@@ -1,7 +1,10 @@
-import gym, os, sys, select
+import gym, os, sys, select, contextlib
+import multiprocessing as mp
 import numpy as np
 from ddpg_agent.ddpg_agent import DDPGAgent
+from ddpg_agent.numpy_actor import NumpyActor
 from tensorboard_evaluation import Evaluation
+from solved_check import SolvedCheck
 
 solved_score = 1000
 
@@ -33,6 +36,7 @@ def train_agent(n_steps: int=500000, render: bool=False, early_stop=True):
 
     while total_steps < n_steps:
         steps, score, done, lo_loss_sum, = 0, 0, False, 0
+        lo_steps = 0  # steps with a gradient update
         state = np.expand_dims(env.reset(), axis=0)
 
         ep += 1
@@ -49,7 +53,10 @@ def train_agent(n_steps: int=500000, render: bool=False, early_stop=True):
 
             lo_loss, hi_loss = agent.train(state, action, reward, next_state, done)
             # this is the single loss if DDPG, or the lo_loss if hierarchical
-            lo_loss_sum += (1 / steps) * (lo_loss - lo_loss_sum) # avoids need to divide by num steps at end
+            # (None if the agent didn't learn at this step)
+            if lo_loss is not None:
+                lo_steps += 1
+                lo_loss_sum += (1 / lo_steps) * (lo_loss - lo_loss_sum) # avoids need to divide by num steps at end
 
             score += reward
             state = next_state
@@ -64,6 +71,7 @@ def train_agent(n_steps: int=500000, render: bool=False, early_stop=True):
                     # 'q' will save the models and and training
                     elif line == 'q':
                         agent.save_model(saved_models_dir)
+                        agent.close()
                         return
                     # 'm' for more episodes
                     elif line == 'm':
@@ -108,19 +116,65 @@ def train_agent(n_steps: int=500000, render: bool=False, early_stop=True):
             print('Initiating tests...')
             agent.save_model(saved_models_dir)
             if isSolved(min_score=solved_score):
+                agent.close()
                 return
 
     agent.save_model(saved_models_dir)
-
-def test_agent(n_episodes: int=10, render: bool=True):
+    agent.close()
+
+# environment and actor of a test worker process (see test_agent())
+_test_env, _test_actor = None, None
+
+def _init_test_worker(layers):
+    global _test_env, _test_actor
+    _test_env = gym.make('Ant-v2')
+    _test_actor = NumpyActor.from_layers(layers)
+
+def _test_episode(seed):
+    _test_env.seed(seed)
+    done, score = False, 0
+    state = np.expand_dims(_test_env.reset(), axis=0)
+    while not done:
+        action = np.clip(_test_actor(state), -1, 1)
+        state, reward, done, _ = _test_env.step(np.squeeze(action, axis=0))
+        state = np.expand_dims(state, axis=0)
+        score += reward
+    return score
+
+def test_episodes(agent, n_episodes: int, n_workers: int, seed: int):
+    """
+    Yields the scores of n_episodes test episodes (seeded seed, seed + 1, ...) in episode order,
+    playing n_workers of them at a time in a pool of processes (close() it to stop early)
+    """
+    with mp.Pool(n_workers, initializer=_init_test_worker, initargs=(agent.numpy_actor.layers,)) as pool:
+        for first in range(seed, seed + n_episodes, n_workers):
+            yield from pool.map(_test_episode, range(first, min(first + n_workers, seed + n_episodes)))
+
+def test_agent(n_episodes: int=10, render: bool=True, n_workers: int=1, seed: int=None):
+    """
+    Without rendering, n_workers > 1 spreads the episodes over a pool of processes,
+    each with its own environment and numpy copy of the actor.
+    With the same seed, the same episodes are played every time.
+    """
     env = gym.make('Ant-v2')
 
     agent = DDPGAgent.load_pretrained_agent(
         filepath=saved_models_dir,
         state_space=env.observation_space,
         action_space = env.action_space,
+        numpy_inference=True,
     )
-    
+
+    if n_workers > 1 and not render:
+        seed = np.random.randint(9999) if seed is None else seed
+        with contextlib.closing(test_episodes(agent, n_episodes, n_workers, seed)) as episodes:
+            all_scores = list(episodes)
+        for ep, score in enumerate(all_scores):
+            print(f'Episode {ep} of {n_episodes}. score: {score}')
+        return all_scores
+
+    if seed is not None:
+        env.seed(seed)
     all_scores = []
     for ep in range(n_episodes):
         done, steps, score = False, 0, 0
@@ -142,14 +196,21 @@ def test_agent(n_episodes: int=10, render: bool=True):
         print(f'Episode {ep} of {n_episodes}. score: {score}, steps: {steps}')
     return all_scores
 
-def isSolved(n_episodes=100, min_score=1800):
-    all_scores = test_agent(n_episodes=n_episodes, render=False)
-    average_score = np.mean(all_scores)
-    solved = average_score >= min_score
-    neg = 'not ' if not solved else ' '
-    print (f'\nProblem{neg}solved.')
-    print (f'Mean score over {n_episodes} episodes: {average_score}')
-    return solved
+def isSolved(n_episodes=100, min_score=1800, seed=0):
+    """
+    The mean score over n_episodes test episodes has to reach min_score:
+    stops as soon as a confidence interval of the mean has decided
+    """
+    env = gym.make('Ant-v2')
+    agent = DDPGAgent.load_pretrained_agent(
+        filepath=saved_models_dir,
+        state_space=env.observation_space,
+        action_space = env.action_space,
+        numpy_inference=True,
+    )
+    check = SolvedCheck(min_score, max_episodes=n_episodes, criterion='mean')
+    with contextlib.closing(test_episodes(agent, n_episodes, os.cpu_count(), seed)) as episodes:
+        return check.run(episodes)
 
 
 if __name__ == "__main__":
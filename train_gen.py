@@ -1,15 +1,20 @@
-import select, sys, gym, os
+import select, sys, gym, os, contextlib, functools
 import numpy as np
 import argparse
 
-from continuous_cartpole import ContinuousCartPoleEnv
-from bipedal_walker import BipedalWalker
+from continuous_cartpole import ContinuousCartPoleEnv, VectorContinuousCartPoleEnv
+from bipedal_walker import BipedalWalker, SubprocVectorBipedalWalker
 
 from ddpg_agent.ddpg_agent import DDPGAgent
+from ddpg_agent.actor_learner import ActorLearner
+from ddpg_agent.async_learner import AsyncLearner
 from ddpg_agent.dummy_agent import DummyAgent
 from teacher_agent.teacher_agent import TeacherAgent
+from teacher_agent.planner_agent import PlannerAgent
 from meta_agent import MetaAgent
 from tensorboard_evaluation import Evaluation
+from solved_check import SolvedCheck
+from frame_renderer import VideoWriter, tile_frames
 
 # for CCP and bipedal respectively
 # calculated from inspection / sampling
@@ -23,21 +28,62 @@ HI_ACTION_LIMITS = [[0.4, 0.6, np.pi / 4, 3],
                         0.388096935, 0.314850675
                     ]]
 
+# scores that count as solved, for CCP and bipedal respectively
+SOLVED_SCORES = [1800, 250]
+
 
 def ensure_path(p):
     if not os.path.exists(p):
         os.mkdir(p)
 
 
-def test_agent(n_episodes: int = 10, render: bool = True):
-    env = ContinuousCartPoleEnv() if not COMPLEXENV else BipedalWalker()
-    env.seed(np.random.randint(9999))
-    # load agent
+def check_keyboard_commands(agent, render: bool, n_steps: int):
+    """
+    Applies the commands typed by the user since the last call,
+    returns the updated (render, n_steps) and whether training should stop
+    """
+    quit = False
+    if os.name != 'nt':
+        # check user keyboard commands
+        while sys.stdin in select.select([sys.stdin], [], [], 0)[0]:
+            line = sys.stdin.readline().strip()
+            # 'r' will toggle the render flag
+            if line == 'r':
+                render = not render
+            # 'q' will save the models and and training
+            elif line == 'q':
+                quit = True
+            # 'm' for more episodes
+            elif line == 'm':
+                n_steps += 50000
+            # 'l' for less episodes
+            elif line == 'l':
+                n_steps -= 50000
+            # 'i' will increase the exploration factor
+            elif line == 'i':
+                agent.modify_exploration_magnitude(0.1, mode='increment')
+            # 'd' will decrease the exploration factor
+            elif line == 'd':
+                agent.modify_exploration_magnitude(-0.1, mode='increment')
+            # 'z' will zero the exploration factor
+            elif line == 'z':
+                agent.modify_exploration_magnitude(0.0, mode='assign')
+            # an empty line means stdin has been closed
+            else:
+                print('unknown command')
+    return render, n_steps, quit
+
+
+def load_test_agent(env, n_envs: int = 1):
+    """
+    The saved agent, inference only, for n_envs environments side by side
+    """
     if not HIERARCHY:
         agent = DDPGAgent.load_pretrained_agent(
             filepath=saved_models_dir,
             state_space=env.observation_space,
-            action_space=env.action_space)
+            action_space=env.action_space,
+            numpy_inference=True)
     else:
         hi_action_space = gym.spaces.Box(
             low=np.negative(np.array(HI_ACTION_LIMITS[COMPLEXENV])),
@@ -48,10 +94,31 @@ def test_agent(n_episodes: int = 10, render: bool = True):
             models_dir=saved_models_dir,
             state_space=env.observation_space,
             action_space=env.action_space,
-            hi_agent_cls=DummyAgent,
+            hi_agent_cls=DummyAgent if not PLANNER else PlannerAgent,
             lo_agent_cls=DDPGAgent,
             hi_action_space=hi_action_space,
+            n_envs=n_envs,
         )
+    return agent
+
+
+def test_agent(n_episodes: int = 10,
+               render: bool = True,
+               n_envs: int = 1,
+               seed: int = None,
+               record: str = None):
+    """
+    Without rendering, n_envs > 1 plays that many episodes at a time (see test_agent_batched())
+    With a 'record' path, the episodes are also rendered offscreen into that video file (needs ffmpeg)
+    """
+    if n_envs > 1 and not render:
+        return test_agent_batched(n_episodes, n_envs, seed=seed, record=record)
+
+    env = ContinuousCartPoleEnv() if not COMPLEXENV else BipedalWalker()
+    env.seed(np.random.randint(9999) if seed is None else seed)
+    # load agent
+    agent = load_test_agent(env)
+    video = None
 
     all_scores = []
     for ep in range(n_episodes):
@@ -71,6 +138,12 @@ def test_agent(n_episodes: int = 10, render: bool = True):
                     env.render()
                 else:
                     env.render(goal_state=goal_state)
+            if record is not None:
+                frame = env.render('rgb_array', goal_state=goal_state if HIERARCHY else None)
+                if video is None:
+                    video = VideoWriter(record, frame.shape[1], frame.shape[0],
+                                        fps=env.metadata['video.frames_per_second'])
+                video.write(frame)
 
             if HIERARCHY:
                 goal_state = np.squeeze(state + agent.goal)
@@ -92,42 +165,133 @@ def test_agent(n_episodes: int = 10, render: bool = True):
         all_scores.append(score)
         print(f'Episode {ep} of {n_episodes}. score: {score}, steps: {steps}')
 
+    if video is not None:
+        video.close()
+    return np.array(all_scores)
+
+
+def test_agent_batched(n_episodes: int, n_envs: int, seed: int = None, record: str = None):
+    """
+    Same as test_agent() without rendering, but plays n_envs episodes at a time
+    on a vectorized environment (a process per walker for the bipedal walker).
+    With the same seed, the same episodes are played every time.
+    With a 'record' path, the n_envs environments are recorded side by side into that video file.
+    """
+    n_envs = min(n_envs, n_episodes)
+    seed = np.random.randint(9999) if seed is None else seed
+    all_scores = []
+    with contextlib.closing(test_episodes(n_episodes, n_envs, seed, record)) as episodes:
+        for score in episodes:
+            all_scores.append(score)
+            print(
+                f'Episode {len(all_scores) - 1} of {n_episodes}. score: {score}'
+            )
     return np.array(all_scores)
 
 
-def isSolved(n_episodes=100, min_score=1800):
-    all_scores = test_agent(n_episodes=n_episodes, render=False)
-    average_score = np.mean(all_scores)
-    results = all_scores > min_score
-    solved = np.all(results)
-    failures = n_episodes - np.sum(results)
-    neg = 'not ' if not solved else ' '
-    print(f'\nProblem{neg}solved.')
-    print(f'Mean score over {n_episodes} episodes: {average_score}')
-    print(f'Failed episodes: {failures}')
-    return solved
+def test_episodes(n_episodes: int, n_envs: int, seed: int, record: str = None):
+    """
+    Yields the scores of n_episodes test episodes in episode order, playing n_envs of them at a time
+    (close() it to stop early), optionally recording all the environments into the video file 'record'.
+    Env i plays episodes i, i + n_envs, i + 2 * n_envs, ... and sits idle once it has played its share,
+    so which episodes are played doesn't depend on how long the others last: scores that finish early
+    wait for the episodes before them, instead of crowding out the long ones.
+    """
+    n_envs = min(n_envs, n_episodes)
+    if not COMPLEXENV:
+        env = VectorContinuousCartPoleEnv(n_envs)
+        env.seed(seed)
+    else:
+        env = SubprocVectorBipedalWalker(n_envs, seed=seed)
+    agent = load_test_agent(env, n_envs)
+    video = None
+
+    episode = np.arange(n_envs)  # index of the episode every env is playing
+    active = np.ones(n_envs, dtype=np.bool_)
+    finished = {}  # scores of episodes finished ahead of their turn
+    next_episode = 0
+    steps = np.zeros(n_envs, dtype=np.int64)
+    scores = np.zeros(n_envs)
+    state = env.reset()
+    if HIERARCHY:
+        agent.reset_clock()
+
+    try:
+        while next_episode < n_episodes:
+            action = agent.act(state)
 
+            if record is not None:
+                frame = tile_frames(env.render('rgb_array', goal_states=state + agent.goal if HIERARCHY else None))
+                if video is None:
+                    video = VideoWriter(record, frame.shape[1], frame.shape[0],
+                                        fps=env.metadata['video.frames_per_second'])
+                video.write(frame)
 
-def train_agent(n_steps: int = 500000, render: bool = True, early_stop=True):
-    env = ContinuousCartPoleEnv() if not COMPLEXENV else BipedalWalker()
-    env.seed(np.random.randint(9999))
+            scaled_action = agent.scale_action(action)
+            next_state, reward, done, info = env.step(scaled_action)
+
+            if HIERARCHY:
+                final_state = np.copy(next_state)
+                final_state[done] = info['terminal_observations']
+                agent.goal = agent.goal_transition(agent.goal, state,
+                                                   final_state)
+
+            steps += 1
+            scores += reward
+            cut_off = (steps >= MAX_STEPS_PER_EP) & ~done & active
+            done = (done | cut_off) & active
+            state = env.reset_done(cut_off) if cut_off.any() else next_state
+
+            for i in np.flatnonzero(done):
+                finished[episode[i]] = scores[i]
+                episode[i] += n_envs
+                active[i] = episode[i] < n_episodes
+            while next_episode in finished:
+                yield finished.pop(next_episode)
+                next_episode += 1
+            steps[done] = 0
+            scores[done] = 0
+            if HIERARCHY:
+                agent.reset_clock(done)
+    finally:
+        if video is not None:
+            video.close()
+        env.close()
+
+
+def isSolved(n_episodes=100, min_score=1800, seed=0):
+    """
+    Every one of n_episodes test episodes has to score more than min_score:
+    stops at the first one that doesn't
+    """
+    check = SolvedCheck(min_score, max_episodes=n_episodes, criterion='all')
+    with contextlib.closing(test_episodes(n_episodes, EVAL_ENVS, seed)) as episodes:
+        return check.run(episodes)
+
+
+def new_tensorboard() -> Evaluation:
+    """
+    The Evaluation that training episodes are logged to, under ./tensorboard/NAME
+    """
     tensorboard_path = os.path.join(".", "tensorboard")
     ensure_path(tensorboard_path)
     tensorboard_path = os.path.join(tensorboard_path, NAME)
     ensure_path(tensorboard_path)
-    solved_score = 1800 if not COMPLEXENV else 250
-
-    # we need to create the Tensorboard network BEFORE the agent, otherwise it gets angry
-    # this could be done better, but oh well.
 
     train_dict_keys = ["score", "loss", "expl"] if not HIERARCHY else [
         "hi_score", "hi_loss", "hi_expl", "lo_score", "lo_loss", "lo_expl"
     ]
-    tensorboard = Evaluation(tensorboard_path, train_dict_keys)
+    return Evaluation(tensorboard_path, train_dict_keys)
 
+
+def new_agent(env, n_envs: int = 1, numpy_inference: bool = False):
+    """
+    A new trainable agent for 'env' (or for n_envs of them stepped side by side):
+    DDPG, or a MetaAgent with HIERARCHY
+    """
     if not HIERARCHY:
         # create new naive agent
-        agent = DDPGAgent.new_trainable_agent(
+        return DDPGAgent.new_trainable_agent(
             state_space=env.observation_space,
             action_space=env.action_space,
             exploration_mode="gaussian",
@@ -135,26 +299,127 @@ def train_agent(n_steps: int = 500000, render: bool = True, early_stop=True):
             exploration_decay=0.99999,
             learning_rate_actor=0.001,
             learning_rate_critic=0.001,
+            numpy_inference=numpy_inference,
+            **TRAIN_SCHEDULE,
         )
-    else:
-        hi_action_space = gym.spaces.Box(
-            low=np.negative(np.array(HI_ACTION_LIMITS[COMPLEXENV])),
-            high=np.array(HI_ACTION_LIMITS[COMPLEXENV]),
-            dtype=env.observation_space.dtype)
 
-        agent = MetaAgent(
-            env.observation_space,
-            env.action_space,
-            hi_agent_cls=DDPGAgent,
-            lo_agent_cls=DDPGAgent,
-            hi_action_space=hi_action_space,
-            c=10,
+    hi_action_space = gym.spaces.Box(
+        low=np.negative(np.array(HI_ACTION_LIMITS[COMPLEXENV])),
+        high=np.array(HI_ACTION_LIMITS[COMPLEXENV]),
+        dtype=env.observation_space.dtype)
+
+    return MetaAgent(
+        env.observation_space,
+        env.action_space,
+        hi_agent_cls=DDPGAgent if not PLANNER else PlannerAgent,
+        lo_agent_cls=DDPGAgent,
+        hi_action_space=hi_action_space,
+        c=10,
+        n_envs=n_envs,
+    )
+
+
+def log_episode(tensorboard,
+                agent,
+                ep: int,
+                source: str,
+                steps: int,
+                score: float,
+                loss: float,
+                total_steps: int,
+                n_steps: int,
+                lo_score: float = 0,
+                hi_loss: float = 0,
+                explr_magnitude: float = None):
+    """
+    Prints a finished episode and writes it to tensorboard.
+    'source' tells where it was played (e.g. ' (env 3)'), 'loss' is the lo agent's with HIERARCHY.
+    'explr_magnitude' defaults to the agent's own
+    """
+    if not HIERARCHY:
+        if explr_magnitude is None:
+            explr_magnitude = agent.explr_magnitude
+        print(
+            f' Episode {ep:4d}{source}. Steps: {steps:4d}, Score: {score:4f}, Loss: {loss:.3f},'
+            + f' Expl: {explr_magnitude:6f}, ' +
+            f' Global step: {total_steps} of {n_steps} ({(total_steps*100/n_steps):.2f}%)'
+        )
+        tensorboard.write_episode_data(
+            ep,
+            eval_dict={
+                "score": score,
+                "loss": loss,
+                "expl": explr_magnitude,
+            })
+    else:
+        print(
+            f'Episode {ep:4d}{source}, score: {score:.1f}, lo_score: {lo_score:.2f} '
+            + f'steps: {steps:4d}, ' + f'lo_loss: {loss:.3f}, ' +
+            f'hi_loss: {hi_loss:.3f}, ' +
+            f'lo_expl: {agent.lo_agent.explr_magnitude:6f}, ' +
+            f'hi_expl: {agent.hi_agent.explr_magnitude:6f}, ' +
+            f'Global step: {total_steps} of {n_steps} ({(total_steps*100/n_steps):.2f}%)'
         )
+        tensorboard.write_episode_data(
+            ep,
+            eval_dict={
+                "hi_score": score,
+                "hi_loss": hi_loss,
+                "hi_expl": agent.hi_agent.explr_magnitude,
+                "lo_score": lo_score,
+                "lo_loss": loss,
+                "lo_expl": agent.lo_agent.explr_magnitude,
+            })
+
+
+def passes_early_stop(agent, score: float,
+                      pause_learner=contextlib.nullcontext()) -> bool:
+    """
+    Whether an agent that just scored 'score' while training passes the early stop test
+    (only tested once the score is close enough to SOLVED_SCORES).
+    The networks are saved first, holding 'pause_learner'
+    """
+    solved_score = SOLVED_SCORES[COMPLEXENV]
+    if score <= 0.8 * solved_score:
+        return False
+    print(
+        f'\n\n The agent reached a score of {score} while training. It is now eligible for an early stop test.'
+    )
+    print('Initiating tests...')
+    with pause_learner:
+        agent.save_model(saved_models_dir)
+    return isSolved(min_score=solved_score)
+
+
+def train_agent(n_steps: int = 500000,
+                render: bool = True,
+                early_stop=True,
+                pipelined=False,
+                max_update_ratio=1.):
+    """
+    With 'pipelined' (DDPG only), gradient steps run on a background thread (see ddpg_agent.async_learner),
+    at most max_update_ratio of them per environment step, while this one keeps stepping the environment
+    """
+    assert not (pipelined and HIERARCHY), 'pipelined training is only available for plain DDPG'
+    env = ContinuousCartPoleEnv() if not COMPLEXENV else BipedalWalker(
+        terrain_pool_size=TERRAIN_POOL)
+    env.seed(np.random.randint(9999))
+
+    # we need to create the Tensorboard network BEFORE the agent, otherwise it gets angry
+    # this could be done better, but oh well.
+    tensorboard = new_tensorboard()
+    agent = new_agent(env, numpy_inference=pipelined)
+
+    learner = AsyncLearner(
+        agent, max_update_ratio=max_update_ratio) if pipelined else None
+    # the networks must not change while they are being saved
+    pause_learner = learner.update_lock if pipelined else contextlib.nullcontext()
 
     total_steps, ep = 0, 0
 
     while total_steps < n_steps:
         steps, hi_steps, score, lo_score, done, lo_loss_sum, hi_loss_sum = 0, 0, 0, 0, False, 0, 0
+        lo_steps = 0  # steps with a gradient update
         state = env.reset()
         if HIERARCHY:
             agent.reset_clock()
@@ -182,12 +447,20 @@ def train_agent(n_steps: int = 500000, render: bool = True, early_stop=True):
                 reward -= 1
                 done = True  #Is this reasonable? Probably
 
-            lo_loss, hi_loss = agent.train(state, action, reward, next_state,
-                                           done)
-            # this is the single loss if DDPG, or the lo_loss if hierarchical
-            lo_loss_sum += (1 / steps) * (
-                lo_loss - lo_loss_sum
-            )  # avoids need to divide by num steps at end
+            if not pipelined:
+                lo_loss, hi_loss = agent.train(state, action, reward,
+                                               next_state, done)
+                # this is the single loss if DDPG, or the lo_loss if hierarchical
+                # (None if the agent didn't learn at this step)
+                if lo_loss is not None:
+                    lo_steps += 1
+                    lo_loss_sum += (1 / lo_steps) * (
+                        lo_loss - lo_loss_sum
+                    )  # avoids need to divide by num steps at end
+            else:
+                agent.add_transitions(state, action, reward, next_state, done)
+                learner.step()
+                hi_loss = None
 
             if HIERARCHY:
                 agent.goal = agent.goal_transition(agent.goal, state,
@@ -203,89 +476,221 @@ def train_agent(n_steps: int = 500000, render: bool = True, early_stop=True):
             state = next_state
 
             if HIERARCHY:
-                lo_score += agent.lo_reward
-
-            if os.name != 'nt':
-                # check user keyboard commands
-                while sys.stdin in select.select([sys.stdin], [], [], 0)[0]:
-                    line = sys.stdin.readline().strip()
-                    # 'r' will toggle the render flag
-                    if line == 'r':
-                        render = not render
-                    # 'q' will save the models and and training
-                    elif line == 'q':
-                        agent.save_model(saved_models_dir)
-                        return
-                    # 'm' for more episodes
-                    elif line == 'm':
-                        n_steps += 50000
-                    # 'l' for less episodes
-                    elif line == 'l':
-                        n_steps -= 50000
-                    # 'i' will increase the exploration factor
-                    elif line == 'i':
-                        agent.modify_exploration_magnitude(
-                            0.1, mode='increment')
-                    # 'd' will decrease the exploration factor
-                    elif line == 'd':
-                        agent.modify_exploration_magnitude(
-                            -0.1, mode='increment')
-                    # 'z' will zero the exploration factor
-                    elif line == 'z':
-                        agent.modify_exploration_magnitude(0.0, mode='assign')
-                    # an empty line means stdin has been closed
-                    else:
-                        print('unknown command')
+                lo_score += agent.lo_reward[0]
+
+            render, n_steps, quit = check_keyboard_commands(
+                agent, render, n_steps)
+            if quit:
+                if pipelined:
+                    learner.stop()
+                agent.save_model(saved_models_dir)
+                agent.close()
+                return
 
         total_steps += steps
+        if pipelined:
+            lo_loss_sum = learner.pop_loss()
+
+        log_episode(
+            tensorboard,
+            agent,
+            ep,
+            '',
+            steps,
+            score,
+            lo_loss_sum,
+            total_steps,
+            n_steps,
+            lo_score=lo_score,
+            hi_loss=hi_loss_sum)
 
-        if not HIERARCHY:
-            print(
-                f' Episode {ep:4d}. Steps: {steps:4d}, Score: {score:4f}, Loss: {lo_loss_sum:.3f},'
-                + f' Expl: {agent.explr_magnitude:6f}, ' +
-                f' Global step: {total_steps} of {n_steps} ({(total_steps*100/n_steps):.2f}%)'
-            )
-            tensorboard.write_episode_data(
-                ep,
-                eval_dict={
-                    "score": score,
-                    "loss": lo_loss_sum,
-                    "expl": agent.explr_magnitude,
-                })
-        else:
-            print(
-                f'Episode {ep:4d}, score: {score:.1f}, lo_score: {lo_score:.2f} '
-                + f'steps: {steps:4d}, ' + f'lo_loss: {lo_loss_sum:.3f}, ' +
-                f'hi_loss: {hi_loss_sum:.3f}, ' +
-                f'lo_expl: {agent.lo_agent.explr_magnitude:6f}, ' +
-                f'hi_expl: {agent.hi_agent.explr_magnitude:6f}, ' +
-                f'Global step: {total_steps} of {n_steps} ({(total_steps*100/n_steps):.2f}%)'
-            )
-            tensorboard.write_episode_data(
+        if ep % 100 == 0:
+            with pause_learner:
+                agent.save_model(saved_models_dir)
+
+        #Early stop test
+        if early_stop and passes_early_stop(agent, score, pause_learner):
+            if pipelined:
+                learner.stop()
+            agent.close()
+            return
+
+    if pipelined:
+        learner.stop()
+    agent.save_model(saved_models_dir)
+    agent.close()
+
+
+def train_agent_batched(n_envs: int,
+                        n_steps: int = 500000,
+                        early_stop=True):
+    """
+    Same as train_agent(), but steps n_envs environments side by side:
+    act() and train() are called once per step for all of them, on (n_envs, state_dim) batches.
+    Exploration and the train_freq schedule still count environment steps, as with a single environment
+    """
+    if not COMPLEXENV:
+        env = VectorContinuousCartPoleEnv(n_envs)
+        env.seed(np.random.randint(9999))
+    else:
+        env = SubprocVectorBipedalWalker(
+            n_envs,
+            seed=np.random.randint(9999),
+            terrain_pool_size=TERRAIN_POOL)
+
+    tensorboard = new_tensorboard()
+    agent = new_agent(env, n_envs=n_envs)
+
+    # per-environment episode bookkeeping
+    steps = np.zeros(n_envs, dtype=np.int64)
+    scores = np.zeros(n_envs)
+    loss_sums = np.zeros(n_envs)
+    lo_steps = np.zeros(n_envs, dtype=np.int64)
+    hi_steps = np.zeros(n_envs, dtype=np.int64)
+    hi_loss_sums = np.zeros(n_envs)
+    lo_scores = np.zeros(n_envs)
+    total_steps, ep = 0, 0
+    render = False
+
+    state = env.reset()
+    while total_steps < n_steps:
+        steps += 1
+        total_steps += n_envs
+        action = agent.act(state=state)
+
+        scaled_action = agent.scale_action(action)
+        next_state, reward, done, info = env.step(scaled_action)
+
+        # finished environments were reset already: train on their final observations
+        final_state = np.copy(next_state)
+        final_state[done] = info['terminal_observations']
+
+        timeout = steps >= MAX_STEPS_PER_EP
+        reward = np.where(timeout, reward - 1, reward)
+        # environments cut off by the step limit (rather than finished) still need a reset
+        cut_off = timeout & ~done
+        done = done | timeout
+
+        loss, hi_loss = agent.train(state, action, reward, final_state, done)
+        if loss is not None:
+            lo_steps += 1
+            loss_sums += (1 / lo_steps) * (loss - loss_sums)
+        scores += reward
+
+        if HIERARCHY:
+            agent.goal = agent.goal_transition(agent.goal, state, final_state)
+            lo_scores += agent.lo_reward
+            if hi_loss is not None:
+                # the environments whose HL agent has just been trained
+                hi_trained = agent.t % agent.c == 0
+                hi_steps += hi_trained
+                hi_loss_sums[hi_trained] += (
+                    1 / hi_steps[hi_trained]) * (hi_loss -
+                                                 hi_loss_sums[hi_trained])
+
+        render, n_steps, quit = check_keyboard_commands(agent, render, n_steps)
+        if quit:
+            agent.save_model(saved_models_dir)
+            agent.close()
+            env.close()
+            return
+
+        state = env.reset_done(cut_off) if cut_off.any() else next_state
+
+        for i in np.flatnonzero(done):
+            ep += 1
+            log_episode(
+                tensorboard,
+                agent,
                 ep,
-                eval_dict={
-                    "hi_score": score,
-                    "hi_loss": hi_loss_sum,
-                    "hi_expl": agent.hi_agent.explr_magnitude,
-                    "lo_score": lo_score,
-                    "lo_loss": lo_loss_sum,
-                    "lo_expl": agent.lo_agent.explr_magnitude,
-                })
+                f' (env {i})',
+                steps[i],
+                scores[i],
+                loss_sums[i],
+                total_steps,
+                n_steps,
+                lo_score=lo_scores[i],
+                hi_loss=hi_loss_sums[i])
+
+            if ep % 100 == 0:
+                agent.save_model(saved_models_dir)
+
+            #Early stop test
+            if early_stop and passes_early_stop(agent, scores[i]):
+                agent.close()
+                env.close()
+                return
+
+        steps[done] = 0
+        scores[done] = 0
+        loss_sums[done] = 0
+        lo_steps[done] = 0
+        hi_steps[done] = 0
+        hi_loss_sums[done] = 0
+        lo_scores[done] = 0
+        if HIERARCHY:
+            agent.reset_clock(done)
+
+    agent.save_model(saved_models_dir)
+    agent.close()
+    env.close()
+
+
+def train_agent_distributed(n_actors: int,
+                            n_steps: int = 500000,
+                            early_stop=True,
+                            max_update_ratio=1.):
+    """
+    Same as train_agent(), but experience is collected by n_actors processes
+    (see ddpg_agent.actor_learner) while this one only learns,
+    at most max_update_ratio gradient steps per environment step collected
+    """
+    assert not HIERARCHY, 'distributed training is only available for plain DDPG'
+    env_cls = ContinuousCartPoleEnv if not COMPLEXENV else functools.partial(
+        BipedalWalker, terrain_pool_size=TERRAIN_POOL)
+    env = env_cls()
+
+    tensorboard = new_tensorboard()
+    agent = new_agent(env)
+
+    learner = ActorLearner(
+        agent,
+        env_cls,
+        n_actors=n_actors,
+        max_steps_per_ep=MAX_STEPS_PER_EP,
+        timeout_penalty=1,
+        max_update_ratio=max_update_ratio)
+
+    ep = 0
+    render = False
+    for i, score, steps, loss, explr_magnitude in learner.episodes(n_steps):
+        ep += 1
+        log_episode(
+            tensorboard,
+            agent,
+            ep,
+            f' (actor {i}, {learner.n_updates} updates)',
+            steps,
+            score,
+            loss,
+            learner.total_steps,
+            n_steps,
+            explr_magnitude=explr_magnitude)
+
+        render, n_steps, quit = check_keyboard_commands(agent, render, n_steps)
+        if quit:
+            break
 
         if ep % 100 == 0:
             agent.save_model(saved_models_dir)
 
         #Early stop test
-        if early_stop and score > 0.8 * solved_score:
-            print(
-                f'\n\n The agent reached a score of {score} while training. It is now eligible for an early stop test.'
-            )
-            print('Initiating tests...')
-            agent.save_model(saved_models_dir)
-            if isSolved(min_score=solved_score):
-                return
+        if early_stop and passes_early_stop(agent, score):
+            break
 
+    learner.stop()
     agent.save_model(saved_models_dir)
+    agent.close()
 
 
 if __name__ == "__main__":
@@ -306,21 +711,84 @@ if __name__ == "__main__":
         action="store_true",
         default=False,
         help="Run Hierarchical (rather than DDPG)")
+    parser.add_argument(
+        "--planner",
+        action="store_true",
+        default=False,
+        help="Plan high-level goals on the cartpole model (CCP and --hier only)")
     parser.add_argument(
         "--walker",
         action="store_true",
         default=False,
         help="Run Bipedal Walker (rather than CCP)")
+    parser.add_argument(
+        "--terrain_pool",
+        default=None,
+        type=int,
+        help="number of terrains the training walkers draw from (default: a new one every episode)")
     parser.add_argument(
         "--render", action="store_true", default=False, help="show window")
+    parser.add_argument(
+        "--envs",
+        default=1,
+        type=int,
+        help="number of environments to train on side by side")
+    parser.add_argument(
+        "--actors",
+        default=0,
+        type=int,
+        help="number of experience-collecting processes (DDPG only)")
+    parser.add_argument(
+        "--pipelined",
+        action="store_true",
+        default=False,
+        help="learn on a background thread while stepping the environment (DDPG only)")
+    parser.add_argument(
+        "--max_update_ratio",
+        default=1.,
+        type=float,
+        help="most gradient steps per environment step when pipelined or with actors")
+    parser.add_argument(
+        "--train_freq",
+        default=1,
+        type=int,
+        help="environment steps between training (DDPG only)")
+    parser.add_argument(
+        "--gradient_steps",
+        default=1,
+        type=int,
+        help="gradient steps per training (DDPG only)")
+    parser.add_argument(
+        "--learning_starts",
+        default=0,
+        type=int,
+        help="random environment steps before training starts (DDPG only)")
+    parser.add_argument(
+        "--eval_envs",
+        default=10,
+        type=int,
+        help="number of test episodes played at a time by the early stop test")
+    parser.add_argument(
+        "--record",
+        default=None,
+        type=str,
+        help="record the final test episodes offscreen into this video file instead of showing them (needs ffmpeg)")
     args = parser.parse_args()
 
     # global settings
     NAME = args.name
     COMPLEXENV = args.walker
     HIERARCHY = args.hier
+    PLANNER = args.planner
+    assert not PLANNER or (HIERARCHY and not COMPLEXENV), 'the planner is a high-level agent for CCP'
     RENDER = args.render
     MAX_STEPS_PER_EP = 2000
+    EVAL_ENVS = args.eval_envs
+    TERRAIN_POOL = args.terrain_pool
+    TRAIN_SCHEDULE = dict(
+        train_freq=args.train_freq,
+        gradient_steps=args.gradient_steps,
+        learning_starts=args.learning_starts)
 
     # print(args)
     #override here for ease of testing
@@ -336,5 +804,17 @@ if __name__ == "__main__":
     # Fixing seed for comparing features
     np.random.seed(0)
 
-    train_agent(n_steps=args.steps, render=RENDER)
-    test_agent()
+    if args.actors > 0:
+        train_agent_distributed(
+            n_actors=args.actors,
+            n_steps=args.steps,
+            max_update_ratio=args.max_update_ratio)
+    elif args.envs > 1:
+        train_agent_batched(n_envs=args.envs, n_steps=args.steps)
+    else:
+        train_agent(
+            n_steps=args.steps,
+            render=RENDER,
+            pipelined=args.pipelined,
+            max_update_ratio=args.max_update_ratio)
+    test_agent(render=args.record is None, record=args.record)